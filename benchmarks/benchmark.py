@@ -0,0 +1,209 @@
+"""Offline parse and render benchmarks.
+
+Runs the recorded GetDepBoardWithDetails responses in benchmarks/fixtures
+through ProcessDepartures, drawSignage and virtual.refresh() on a luma dummy
+device, so no API key or display hardware is needed, and prints the timings
+as JSON:
+
+    python3 benchmarks/benchmark.py --frames 500 --output bench.json
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+from luma.core.device import dummy
+from luma.core.framebuffer import diff_to_previous, full_frame
+from luma.core.interface.serial import noop
+from luma.oled.device import ssd1322
+
+import main
+from partialdisplay import CaptureSerial, DirtyBands, FastSSD1322
+from trains import ProcessDepartures
+
+FIXTURES = ['small', 'large_splits', 'bus_only', 'train_and_bus', 'empty']
+JOURNEY_CONFIG = {"individualStationDepartureTime": True}
+CONFIG = {"refreshTime": 180, "showDepartureNumbers": False}
+
+
+def loadFixture(name):
+    with open(os.path.join(ROOT, 'benchmarks', 'fixtures', name + '.xml'), 'rb') as fixture:
+        return fixture.read()
+
+
+def timeIt(fn, iterations):
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return result, {
+        'mean_ms': sum(timings) / len(timings) * 1000,
+        'min_ms': timings[0] * 1000,
+        'max_ms': timings[-1] * 1000,
+        'median_ms': timings[len(timings) // 2] * 1000
+    }
+
+
+def measureAllocations(fn):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = fn()
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    stats = after.compare_to(before, 'filename')
+    return result, {
+        'peak_bytes': peak,
+        'allocated_blocks': sum(s.count_diff for s in stats if s.count_diff > 0),
+        'retained_bytes': sum(s.size_diff for s in stats)
+    }
+
+
+def buildBoard(device, departures, stationName):
+    if departures is None:
+        return main.drawBlankSignage(device, width=device.width, height=device.height, departureStation=stationName)
+    data = departures, departures[0].calling_at_list, stationName
+    return main.drawSignage(device, width=device.width, height=device.height, data=data)
+
+
+def runFrames(virtual, frames):
+    # in the real loop the scroller (0.02 s) and clock (0.1 s) redraw on nearly
+    # every frame; mark them due each time so the tight loop does the same work
+    fastHotspots = [h for h, _ in virtual._hotspots if getattr(h, 'interval', 0) <= 0.1]
+    start = time.perf_counter()
+    for _ in range(frames):
+        for hotspot in fastHotspots:
+            hotspot.last_updated = -hotspot.interval
+        virtual.refresh()
+    elapsed = time.perf_counter() - start
+    return {
+        'frames': frames,
+        'fps': frames / elapsed,
+        'mean_frame_ms': elapsed / frames * 1000
+    }
+
+
+def measurePanelBytes(departures, stationName, frames, partial):
+    # an SSD1322 on a capturing serial interface, so the bytes that would go over SPI
+    # can be counted and the panel's RAM compared with what should be on it
+    serial = CaptureSerial()
+    framebuffer = DirtyBands() if partial else diff_to_previous()
+    device = ssd1322(serial, mode="1", rotate=2, framebuffer=framebuffer)
+    virtual = buildBoard(device, departures, stationName)
+
+    fastHotspots = [h for h, _ in virtual._hotspots if getattr(h, 'interval', 0) <= 0.1]
+    start = serial.command_bytes + serial.data_bytes
+    for _ in range(frames):
+        for hotspot in fastHotspots:
+            hotspot.last_updated = -hotspot.interval
+        if partial:
+            framebuffer.begin(virtual)
+        virtual.refresh()
+
+    expected = device.preprocess(virtual._backing_image.crop(virtual._crop_box())).convert('L')
+    return {
+        'bytes_per_frame': (serial.command_bytes + serial.data_bytes - start) / frames,
+        'panel_matches': expected.point(lambda p: 255 if p else 0).tobytes() == serial.frame().point(lambda p: 255 if p else 0).tobytes()
+    }
+
+
+def measurePacking(departures, stationName, frames):
+    # the same frames through luma's ssd1322 and FastSSD1322, each sent in full so
+    # packing is all that differs; the two panels' RAM must match after every frame
+    virtual = buildBoard(dummy(width=256, height=64, rotate=2, mode="1"), departures, stationName)
+    fastHotspots = [h for h, _ in virtual._hotspots if getattr(h, 'interval', 0) <= 0.1]
+    images = []
+    for _ in range(frames):
+        for hotspot in fastHotspots:
+            hotspot.last_updated = -hotspot.interval
+        virtual.refresh()
+        images.append(virtual._backing_image.crop(virtual._crop_box()))
+
+    serials = CaptureSerial(), CaptureSerial()
+    stock = ssd1322(serials[0], mode="1", rotate=2, framebuffer=full_frame())
+    fast = FastSSD1322(serials[1], mode="1", rotate=2, framebuffer=full_frame())
+    identical = True
+    for image in images:
+        stock.display(image)
+        fast.display(image)
+        identical = identical and serials[0].ram == serials[1].ram
+    identical = identical and (serials[0].command_bytes, serials[0].data_bytes) == (serials[1].command_bytes, serials[1].data_bytes)
+
+    # timed on a serial interface that discards everything, so only the device's own work counts
+    results = {'vectorised': fast.vectorised, 'identical': identical}
+    for name, deviceClass in (('stock', ssd1322), ('fast', FastSSD1322)):
+        device = deviceClass(noop(), mode="1", rotate=2, framebuffer=full_frame())
+        # untimed, as FastSSD1322 imports NumPy after its first frame
+        device.display(images[0])
+        start = time.perf_counter()
+        for image in images:
+            device.display(image)
+        results[name + '_frame_ms'] = (time.perf_counter() - start) / frames * 1000
+    return results
+
+
+def benchmarkFixture(name, device, iterations, frames):
+    APIOut = loadFixture(name)
+    parse = lambda: ProcessDepartures(JOURNEY_CONFIG, APIOut, 3)
+
+    (departures, stationName), parseTimes = timeIt(parse, iterations)
+    _, parseAllocations = measureAllocations(parse)
+
+    virtual, signageTimes = timeIt(lambda: buildBoard(device, departures, stationName), iterations)
+    _, signageAllocations = measureAllocations(lambda: buildBoard(device, departures, stationName))
+
+    return {
+        'fixture': name,
+        'bytes': len(APIOut),
+        'departures': 0 if departures is None else len(departures),
+        'parse': dict(parseTimes, **parseAllocations),
+        'draw_signage': dict(signageTimes, **signageAllocations),
+        'refresh': runFrames(virtual, frames),
+        'panel': {
+            'diff_to_previous': measurePanelBytes(departures, stationName, frames, False),
+            'dirty_bands': measurePanelBytes(departures, stationName, frames, True)
+        },
+        'packing': measurePacking(departures, stationName, frames)
+    }
+
+
+def runBenchmarks():
+    parser = argparse.ArgumentParser(description='Offline parse and render benchmarks')
+    parser.add_argument('--iterations', type=int, default=50, help='timed runs of each parse and drawSignage')
+    parser.add_argument('--frames', type=int, default=200, help='virtual.refresh() calls per fixture')
+    parser.add_argument('--fixture', action='append', choices=FIXTURES, help='fixture to run; repeat for several, defaults to all')
+    parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    args = parser.parse_args()
+
+    main.config = CONFIG
+    main.loadFonts()
+    main.prewarmText()
+    device = dummy(width=256, height=64, rotate=2, mode="1")
+
+    results = {
+        'python': sys.version.split()[0],
+        'iterations': args.iterations,
+        'results': [benchmarkFixture(name, device, args.iterations, args.frames) for name in args.fixture or FIXTURES],
+        'bitmap_cache': main.bitmapRenderCache.stats()
+    }
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as outputFile:
+            outputFile.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    runBenchmarks()
@@ -0,0 +1,219 @@
+import threading
+from collections import OrderedDict
+
+from PIL import Image, ImageChops, ImageDraw
+from PIL.ImageFont import FreeTypeFont
+
+
+def renderBitmapText(text: str, font: FreeTypeFont) -> Image.Image:
+    _, _, txt_width, txt_height = font.getbbox(text)
+    bitmap = Image.new('L', [txt_width, txt_height], color=0)
+    pre_render_draw = ImageDraw.Draw(bitmap)
+    pre_render_draw.text((0, 0), text=text, font=font, fill=255)
+    return bitmap
+
+
+def toMode(bitmap: Image.Image, mode: str) -> Image.Image:
+    """Convert a rendered 'L' bitmap to the mode of the image it will be drawn on
+
+    For mode "1" every non-zero pixel is lit, which is exactly how luma's mono
+    devices treat the antialiased edges when an 'L' bitmap is blended in.
+    """
+    if bitmap.mode == mode:
+        return bitmap
+    if mode == "1":
+        return bitmap.point(lambda p: 255 if p > 0 else 0, mode="1")
+    return bitmap.convert(mode)
+
+
+# printable ASCII covers everything LDBWS sends for station names and times
+ATLAS_CHARACTERS = ''.join(chr(c) for c in range(32, 127))
+# classic kerning pairs; a font that kerns anything kerns some of these
+KERNING_PAIRS = ['AV', 'AT', 'AY', 'Av', 'Aw', 'Ay', 'LT', 'LV', 'LY', 'To', 'Ta', 'Te', 'Tr', 'Ty',
+                 'Va', 'Ve', 'Wa', 'We', 'Ya', 'Yo', 'r.', 'r,', 'y.', 'y,', 'F.', 'P.']
+
+
+class GlyphAtlas:
+
+    def __init__(self, font: FreeTypeFont, characters: str = ATLAS_CHARACTERS) -> None:
+        """Pre-rendered glyph sprites for one font, so strings can be composed by pasting
+        glyphs side by side instead of being rasterised by FreeType
+
+        The dot-matrix fonts have whole-pixel advances and no kerning, so a composed
+        string is pixel-for-pixel what FreeType would draw. Characters with fractional
+        advances are left out of the atlas, and if the font kerns any of KERNING_PAIRS
+        the atlas is disabled; render() returns None for anything it can't compose,
+        and the caller falls back to FreeType.
+
+        Args:
+            font (FreeTypeFont): Font to build the atlas for.
+            characters (str, optional): Characters to pre-render. Defaults to printable ASCII.
+        """
+        self.font = font
+        # char -> (advance, sprite, overhangs); overhanging sprites spill into
+        # the next glyph's cell and have to be blended rather than pasted
+        self.glyphs: dict[str, tuple[int, Image.Image, bool]] = {}
+
+        for c in characters:
+            advance = font.getlength(c)
+            if advance != int(advance):
+                continue
+            sprite = renderBitmapText(c, font)
+            self.glyphs[c] = (int(advance), sprite, sprite.width > advance)
+
+        self.enabled = all(
+            font.getlength(pair) == sum(self.glyphs[c][0] for c in pair)
+            for pair in KERNING_PAIRS if pair[0] in self.glyphs and pair[1] in self.glyphs
+        )
+
+    def render(self, text: str) -> Image.Image | None:
+        """Compose text from glyph sprites
+
+        Args:
+            text (str): Text to render.
+
+        Returns:
+            Image.Image | None: Bitmap identical to renderBitmapText, or None if text can't be composed from the atlas.
+        """
+        if not self.enabled:
+            return None
+
+        glyphs = self.glyphs
+        x = 0
+        txt_width = 0
+        txt_height = 0
+        for c in text:
+            glyph = glyphs.get(c)
+            if glyph is None:
+                return None
+            advance, sprite, _ = glyph
+            txt_width = max(txt_width, x + sprite.width)
+            txt_height = max(txt_height, sprite.height)
+            x += advance
+
+        bitmap = Image.new('L', [txt_width, txt_height], color=0)
+        x = 0
+        for c in text:
+            advance, sprite, overhangs = glyphs[c]
+            if overhangs:
+                box = (x, 0, x + sprite.width, sprite.height)
+                bitmap.paste(ImageChops.lighter(bitmap.crop(box), sprite), box)
+            else:
+                bitmap.paste(sprite, (x, 0))
+            x += advance
+        return bitmap
+
+
+class BitmapCache:
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 256 * 1024, mode: str = 'L') -> None:
+        """Least recently used cache of pre-rendered text bitmaps
+
+        Entries are evicted once there are more than max_entries of them, or once
+        the bitmaps held add up to more than max_bytes, so a board that runs for
+        months (a new clock string every second, a new calling-points string every
+        refresh) stays within a fixed amount of memory.
+
+        Bitmaps are converted to mode once, when they are cached, so drawing them
+        onto a canvas of the device's own mode needs no conversion on every frame.
+
+        Args:
+            max_entries (int, optional): Most bitmaps to hold. Defaults to 256.
+            max_bytes (int, optional): Most bitmap pixel bytes to hold. Defaults to 256 KiB.
+            mode (str, optional): Mode to hold bitmaps in, e.g. the device's "1". Defaults to 'L'.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.mode = mode
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_held = 0
+
+        # (text, font) -> (txt_width, txt_height, bitmap); fonts hash by identity,
+        # so the same face loaded at two sizes gets two entries
+        self._entries: OrderedDict[tuple[str, FreeTypeFont], tuple[int, int, Image.Image]] = OrderedDict()
+        self._atlases: dict[FreeTypeFont, GlyphAtlas] = {}
+        # hotspots are painted from luma's thread pool, so lookups can race
+        self._lock = threading.Lock()
+
+    def add_atlas(self, font: FreeTypeFont) -> GlyphAtlas:
+        """Build a glyph atlas for font, so misses in that font are composed from
+        glyph sprites rather than rasterised by FreeType
+
+        Args:
+            font (FreeTypeFont): Font to build the atlas for.
+
+        Returns:
+            GlyphAtlas: The new atlas.
+        """
+        atlas = GlyphAtlas(font)
+        self._atlases[font] = atlas
+        return atlas
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, text: str, font: FreeTypeFont) -> tuple[int, int, Image.Image]:
+        """Get the bitmap for text in font, rendering it on a miss
+
+        Args:
+            text (str): Text to render.
+            font (FreeTypeFont): Font to render it in.
+
+        Returns:
+            tuple[int, int, Image.Image]: Width, height and bitmap of the rendered text.
+        """
+        key = (text, font)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        atlas = self._atlases.get(font)
+        bitmap = atlas.render(text) if atlas is not None else None
+        if bitmap is None:
+            bitmap = renderBitmapText(text, font)
+        bitmap = toMode(bitmap, self.mode)
+        entry = (bitmap.width, bitmap.height, bitmap)
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = entry
+                self.bytes_held += self._size(bitmap)
+                self._evict()
+        return entry
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.bytes_held = 0
+
+    def stats(self) -> dict[str, int]:
+        """Snapshot of the cache counters
+
+        Returns:
+            dict[str, int]: entries, bytes, hits, misses and evictions.
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes_held,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+    def _size(self, bitmap: Image.Image) -> int:
+        return bitmap.width * bitmap.height * len(bitmap.getbands())
+
+    def _evict(self) -> None:
+        # always keep the newest entry, even if it is bigger than max_bytes on its own
+        while len(self._entries) > 1 and (len(self._entries) > self.max_entries or self.bytes_held > self.max_bytes):
+            _, (_, _, bitmap) = self._entries.popitem(last=False)
+            self.bytes_held -= self._size(bitmap)
+            self.evictions += 1
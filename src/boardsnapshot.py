@@ -0,0 +1,205 @@
+import json
+import mmap
+import os
+import struct
+import time
+from dataclasses import astuple
+from typing import Any, Callable
+
+from trains import Departure, departureFromFields, dropDeparted
+
+# magic, sequence number, index length, records length. The sequence number is
+# odd while the writer is part way through an update, and goes up by two per board
+HEADER = struct.Struct('<4sQII')
+MAGIC = b'TRB1'
+MIN_CAPACITY = 64 * 1024
+
+
+def pageRound(size: int) -> int:
+    return -(-size // mmap.PAGESIZE) * mmap.PAGESIZE
+
+
+class BoardSnapshotWriter:
+
+    def __init__(self, path: str) -> None:
+        """Publishes each parsed board into a memory-mapped file, so any number of
+        display processes can share one fetch and one parse
+
+        Every departure is stored as its own record, behind a small index that lists
+        the records for each platform, so a display showing one platform only ever
+        decodes that platform's departures.
+
+        Args:
+            path (str): Snapshot file, ideally on a tmpfs such as /dev/shm.
+        """
+        self.path = path
+        self._file = open(path, 'a+b')
+        size = os.fstat(self._file.fileno()).st_size
+        if size < MIN_CAPACITY:
+            self._file.truncate(MIN_CAPACITY)
+            size = MIN_CAPACITY
+        self._map = mmap.mmap(self._file.fileno(), size)
+
+        magic, seq, _, _ = HEADER.unpack_from(self._map)
+        # carry on from an earlier writer's sequence, so readers still see the next board as new
+        self._seq = seq + (seq & 1) if magic == MAGIC else 0
+
+    @property
+    def version(self) -> int:
+        return self._seq // 2
+
+    def write(self, departures: list[Departure] | None, departureStationName: str, fetched_at: float | None = None) -> int:
+        """Replace the board in the snapshot
+
+        Args:
+            departures (list[Departure] | None): Departures to publish, or None if there are none.
+            departureStationName (str): Name to show for the station.
+            fetched_at (float | None, optional): time.time() the departures were fetched at, if they
+                                                 came from a cache. Defaults to now.
+
+        Returns:
+            int: Version of the board just written.
+        """
+        records = []
+        offsets = []
+        platforms: dict[str, list[int]] = {}
+        position = 0
+        for i, departure in enumerate(departures or []):
+            record = json.dumps(astuple(departure), separators=(',', ':')).encode('utf-8')
+            records.append(record)
+            offsets.append((position, len(record)))
+            position += len(record)
+            if departure.platform is not None:
+                platforms.setdefault(departure.platform, []).append(i)
+
+        index = json.dumps({
+            "fetchedAt": time.time() if fetched_at is None else fetched_at,
+            "stationName": departureStationName,
+            "departures": None if departures is None else offsets,
+            "platforms": platforms
+        }, separators=(',', ':')).encode('utf-8')
+
+        size = HEADER.size + len(index) + position
+        if size > len(self._map):
+            # grow the file; readers remap when the header says it got bigger
+            self._map.close()
+            self._file.truncate(pageRound(size))
+            self._map = mmap.mmap(self._file.fileno(), pageRound(size))
+
+        self._seq += 1
+        HEADER.pack_into(self._map, 0, MAGIC, self._seq, 0, 0)
+        self._map[HEADER.size:size] = index + b''.join(records)
+        self._seq += 1
+        HEADER.pack_into(self._map, 0, MAGIC, self._seq, len(index), position)
+        return self.version
+
+    def close(self) -> None:
+        self._map.close()
+        self._file.close()
+
+
+class BoardSnapshotReader:
+
+    def __init__(self, path: str, platform: str = "", max_departures: int | None = None,
+                 make_board: Callable[[list[Departure] | None, str], Any] | None = None, retries: int = 3) -> None:
+        """Reads boards published by a BoardSnapshotWriter in another process
+
+        Has the same latest() as DepartureFetcher, so the render loop can take its
+        boards from either. Checking for a new board only reads the header from the
+        shared mapping, so it is cheap enough to do every frame.
+
+        Args:
+            path (str): Snapshot file the writer publishes to.
+            platform (str, optional): Only show departures from this platform; "" for all. Defaults to "".
+            max_departures (int | None, optional): Most departures to decode. Defaults to all of them.
+            make_board (Callable[[list[Departure] | None, str], Any] | None, optional): Turns the departures and
+                station name into the board latest() returns, e.g. boardData. Defaults to a plain tuple.
+            retries (int, optional): Attempts to read a board the writer is part way through replacing. Defaults to 3.
+        """
+        self.path = path
+        self.platform = platform
+        self.max_departures = max_departures
+        self.make_board = make_board or (lambda departures, departureStationName: (departures, departureStationName))
+        self.retries = retries
+        self.fetching = False
+        self.error: ValueError | None = None
+        # the fetch happens in another process, so only the arrival of boards is known here
+        self.last_fetch_ok: bool | None = None
+        self.last_board_time: float | None = None
+
+        self._file = None
+        self._map: mmap.mmap | None = None
+
+    def latest(self, version: int) -> tuple[int, Any]:
+        """Get the newest board if it is newer than the one the caller already has
+
+        Args:
+            version (int): Version of the board the caller is currently showing, 0 if none.
+
+        Returns:
+            tuple[int, Any]: The current version, and the board from make_board if it has changed since
+                             version, otherwise None. Departures are None if there are none to show on
+                             this platform.
+        """
+        if not self._open():
+            return version, None
+
+        for _ in range(self.retries):
+            magic, seq, indexLength, recordsLength = HEADER.unpack_from(self._map)
+            if magic != MAGIC or seq // 2 == version:
+                return version, None
+            if seq & 1:
+                time.sleep(0.001)
+                continue
+
+            if HEADER.size + indexLength + recordsLength > len(self._map):
+                self._remap()
+            start = HEADER.size + indexLength
+            try:
+                index = json.loads(self._map[HEADER.size:start])
+                offsets = index["departures"]
+                if offsets is not None and self.platform:
+                    offsets = [offsets[i] for i in index["platforms"].get(self.platform, [])]
+                records = [self._map[start + offset:start + offset + length] for offset, length in offsets or []]
+            except (ValueError, KeyError, IndexError, TypeError):
+                # torn by the writer starting on another board
+                continue
+
+            # only trust what was copied if the writer didn't start on another board meanwhile
+            if HEADER.unpack_from(self._map)[1] != seq:
+                continue
+
+            departures = None
+            if offsets is not None:
+                departures = dropDeparted([departureFromFields(json.loads(i)) for i in records])
+                if departures is not None:
+                    departures = departures[:self.max_departures]
+            # as old as the departures, which may have come from the writer's cache
+            self.last_board_time = time.monotonic() - max(time.time() - index["fetchedAt"], 0)
+            return seq // 2, self.make_board(departures, index["stationName"])
+
+        return version, None
+
+    def _open(self) -> bool:
+        if self._map is not None:
+            return True
+        try:
+            self._file = open(self.path, 'rb')
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # the writer hasn't created the file yet
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            return False
+        return True
+
+    def _remap(self) -> None:
+        self._map.close()
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self) -> None:
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+            self._map = None
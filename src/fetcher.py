@@ -0,0 +1,240 @@
+import logging
+import threading
+import time
+from collections import deque
+from datetime import datetime, time as dayTime, timedelta
+from typing import Any, Callable
+
+from open import is_time_between
+from trains import minutesUntilDeparture
+
+
+class DepartureFetcher(threading.Thread):
+
+    def __init__(self, load: Callable[[], Any], interval: float | Callable[[Any], float],
+                 fetched_at: Callable[[Any], float | None] | None = None) -> None:
+        """Fetches departure boards on a background thread so the render loop never waits on the network
+
+        Args:
+            load (Callable[[], Any]): Called with no arguments to fetch and parse a board, e.g. a wrapped loadData.
+                                      Returns None, or raises, if the fetch failed.
+            interval (float | Callable[[Any], float]): Seconds to wait between the end of one fetch and the
+                                                       start of the next, or a callable such as
+                                                       RefreshPolicy.next_interval that is given each
+                                                       board (None if the fetch failed) and returns the wait.
+            fetched_at (Callable[[Any], float | None] | None, optional): Returns the time.time() a board's
+                                                                         departures were fetched at, or None
+                                                                         for now. A board older than the fetch
+                                                                         that returned it, such as one served
+                                                                         from the disk cache during an outage,
+                                                                         counts as a failed fetch. Defaults to
+                                                                         every board being fresh.
+        """
+        super().__init__(name="DepartureFetcher", daemon=True)
+        self.load = load
+        self.interval = interval
+        self.fetched_at = fetched_at
+        self.fetching = False
+        self.error: ValueError | None = None
+        # for the debug screen: whether the last fetch got a fresh board, and when the board shown was fetched
+        self.last_fetch_ok: bool | None = None
+        self.last_board_time: float | None = None
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._board = None
+        self._version = 0
+
+    def run(self) -> None:
+        while not self._stopped.is_set():
+            self.fetching = True
+            started = time.time()
+            try:
+                board = self.load()
+            except ValueError as err:
+                # a configuration problem won't fix itself, so hand it to the render loop
+                self.error = err
+                self.fetching = False
+                return
+            except Exception:
+                # keep showing the last board rather than killing the thread
+                logging.exception("Failed to load departures")
+                board = None
+
+            if board is None:
+                self.last_fetch_ok = False
+            else:
+                fetchedAt = self.fetched_at(board) if self.fetched_at is not None else None
+                self.last_fetch_ok = fetchedAt is None or fetchedAt >= started
+                self.last_board_time = time.monotonic() - (0 if fetchedAt is None else max(time.time() - fetchedAt, 0))
+                self.publish(board)
+            # only once the board is published, so fetching ending without one means the fetch failed
+            self.fetching = False
+
+            self._wake.wait(self.interval(board) if callable(self.interval) else self.interval)
+            self._wake.clear()
+
+    def publish(self, board: Any) -> None:
+        """Swap in a finished board for the render loop to pick up
+
+        Args:
+            board (Any): The fully parsed board, as returned by load.
+        """
+        with self._lock:
+            self._board = board
+            self._version += 1
+
+    def latest(self, version: int) -> tuple[int, Any]:
+        """Get the newest board if it is newer than the one the caller already has
+
+        Args:
+            version (int): Version of the board the caller is currently showing, 0 if none.
+
+        Returns:
+            tuple[int, Any]: The current version, and the board if it has changed since version, otherwise None.
+        """
+        with self._lock:
+            if self._version == version:
+                return version, None
+            return self._version, self._board
+
+    def refresh(self) -> None:
+        """Start the next fetch now instead of waiting for the interval to elapse"""
+        self._wake.set()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._wake.set()
+
+
+class RefreshPolicy:
+
+    def __init__(self, base: float, min_interval: float = 30, max_interval: float = 900,
+                 hourly_budget: int = 0, request_count: Callable[[], int] | None = None,
+                 operating_hours: tuple[int, int] | None = None) -> None:
+        """Picks the wait before the next fetch from the board just fetched, instead of
+        always polling every refreshTime seconds
+
+        Polls faster as the first departure gets close, or while a shown service is
+        delayed or cancelled, and backs off while the board stays the same or there
+        is nothing running. Outside operating_hours no requests are made at all, so
+        rather than backing off it waits for them to begin. Never makes more than
+        hourly_budget requests in any hour.
+
+        Args:
+            base (float): Normal wait, refreshTime.
+            min_interval (float, optional): Shortest wait. Defaults to 30.
+            max_interval (float, optional): Longest wait when backing off. Defaults to 900.
+            hourly_budget (int, optional): Most API requests in any rolling hour; 0 for no limit. Defaults to 0.
+            request_count (Callable[[], int] | None, optional): Returns the running total of API requests made,
+                                                                so service detail requests count against the
+                                                                budget too. Defaults to one request per fetch.
+            operating_hours (tuple[int, int] | None, optional): Start and end hour of operatingHours. Defaults to
+                                                                always operating.
+        """
+        self.base = base
+        self.min_interval = min(min_interval, base)
+        self.max_interval = max(max_interval, base)
+        self.hourly_budget = hourly_budget
+        self.request_count = request_count
+        self.operating_hours = operating_hours
+
+        self.interval = base
+        self._requests: deque[float] = deque()
+        self._last_count = request_count() if request_count else 0
+        self._last_key = None
+        self._stable = 0
+
+    def remaining_budget(self) -> int | None:
+        """Requests left in the current rolling hour
+
+        Returns:
+            int | None: Requests that can still be made, or None if there is no budget.
+        """
+        if self.hourly_budget <= 0:
+            return None
+        self._expire(time.monotonic())
+        return max(self.hourly_budget - len(self._requests), 0)
+
+    def next_interval(self, board: Any) -> float:
+        """Record a fetch and work out how long to wait before the next one
+
+        Args:
+            board (Any): The board as returned by loadData, or None if the fetch failed.
+
+        Returns:
+            float: Seconds to wait.
+        """
+        now = time.monotonic()
+        self._record(now)
+
+        departures = board[0] if board else None
+        closed = self._until_open(datetime.now())
+        if closed is not None:
+            # loadData doesn't call the API out of hours, so there's nothing to back off from
+            self._stable = 0
+            interval = closed
+        elif not departures:
+            # nothing running, or the fetch failed and the old board is still up
+            self._stable += 1
+            interval = self._back_off()
+        else:
+            key = tuple((d.service_id, d.expected_departure, d.status, d.platform) for d in departures)
+            self._stable = self._stable + 1 if key == self._last_key else 0
+            self._last_key = key
+
+            minutes = minutesUntilDeparture(departures[0], datetime.now())
+            disrupted = any(d.status in ("Delayed", "Cancelled") for d in departures)
+            if disrupted or minutes <= 10:
+                # a quarter of the time left, so the countdown to the next train stays accurate
+                interval = max(self.min_interval, min(self.base, minutes * 60 / 4))
+                if disrupted:
+                    interval = min(interval, max(self.min_interval, self.base / 2))
+            else:
+                interval = self._back_off()
+
+        self.interval = max(interval, self._budget_wait(now))
+        logging.debug("Next refresh in %.0fs, %s requests left this hour", self.interval, self.remaining_budget())
+        return self.interval
+
+    def _until_open(self, now: datetime) -> float | None:
+        if self.operating_hours is None:
+            return None
+        start, end = self.operating_hours
+        if is_time_between(dayTime(start, 0), dayTime(end, 0), now.time()):
+            return None
+        opens = now.replace(hour=start, minute=0, second=0, microsecond=0)
+        if opens <= now:
+            opens += timedelta(days=1)
+        # a second over, so the first fetch is sure to be inside the hours
+        return (opens - now).total_seconds() + 1
+
+    def _back_off(self) -> float:
+        return min(self.base * 1.5 ** self._stable, self.max_interval)
+
+    def _record(self, now: float) -> None:
+        if self.request_count is None:
+            made = 1
+        else:
+            count = self.request_count()
+            made = count - self._last_count
+            self._last_count = count
+        self._requests.extend([now] * made)
+        self._expire(now)
+
+    def _expire(self, now: float) -> None:
+        while self._requests and now - self._requests[0] >= 3600:
+            self._requests.popleft()
+
+    def _budget_wait(self, now: float) -> float:
+        if self.hourly_budget <= 0:
+            return 0
+        remaining = self.hourly_budget - len(self._requests)
+        if remaining <= 0:
+            # wait for the oldest requests to drop out of the hour
+            return self._requests[-self.hourly_budget] + 3600 - now
+        if remaining < self.hourly_budget / 4:
+            # running low, so fall back to the rate the budget can sustain
+            return 3600 / self.hourly_budget
+        return 0
@@ -3,12 +3,13 @@
 # See LICENSE.rst for details.
 
 import sys
+import time
 import logging
 import warnings
+from array import array
 
-from luma.core import cmdline, error
 from luma.core.virtual import snapshot, canvas, viewport
-from PIL import ImageDraw
+from PIL import Image, ImageDraw
 from PIL.ImageFont import FreeTypeFont
 from dataclasses import dataclass
 
@@ -20,7 +21,8 @@ class Animation:
         obj_end (tuple[int, int]): End coordinates (x, y) of the object. The object will move to this location by the end of the animation.
         viewport_start (tuple[int, int]): TODO: Not implemented
         viewport_end (tuple[int, int]): TODO: Not implemented
-        start_delay (int, optional): Delay before animation starts. Defaults to 0.
+        start_delay (int, optional): Intervals of the AnimationSequence to wait before the animation starts. Defaults to 0.
+        duration (float | None, optional): Seconds the move takes. Defaults to None, one pixel per interval of the AnimationSequence.
     """
     obj_start: tuple[int, int]
     obj_end: tuple[int, int]
@@ -29,9 +31,29 @@ class Animation:
     viewport_end: tuple[int, int]
 
     start_delay: int = 0
+    duration: float | None = None
+
+    def path(self) -> tuple[array, array]:
+        """Every position the object passes through, one pixel apart along the longer axis
+
+        Returns:
+            tuple[array, array]: x and y coordinates, from obj_start to obj_end inclusive.
+        """
+        (x0, y0), (x1, y1) = self.obj_start, self.obj_end
+        steps = max(abs(x1 - x0), abs(y1 - y0))
+        if steps == 0:
+            return array('i', [x0]), array('i', [y0])
+        # rounded to the nearest pixel, halves always the same way
+        return (array('i', (x0 + (2 * (x1 - x0) * k + steps) // (2 * steps) for k in range(steps + 1))),
+                array('i', (y0 + (2 * (y1 - y0) * k + steps) // (2 * steps) for k in range(steps + 1))))
 
 @dataclass
 class AnimationSequence:
+    """
+        sequence (list[Animation]): Animations to play in order, repeating from the first after the last.
+        interval (float): Seconds between redraws of the object, and the time step of animations without a duration.
+        refresh_animation (Animation | None, optional): TODO: Not implemented
+    """
     sequence: list[Animation]
     interval: float
     refresh_animation: Animation | None = None
@@ -50,8 +72,9 @@ class RenderText:
 class AnimatedObject:
 
     luma_snapshot: snapshot
-    animation_counter: int = 0
     animation_index: int = 0
+    # monotonic time the current animation's delay began, set on the first redraw
+    animation_started: float | None = None
 
     def __init__(self, device, xy: tuple[int, int], text: list[RenderText], viewport: BoundingBox | None = None) -> None:
         """Creates a text object with optional animations
@@ -94,6 +117,9 @@ class AnimatedObject:
         self.text = text
         
         self.animations: AnimationSequence | None = None
+        # per animation: (xs, ys, delay, step, length), all times in seconds
+        self._paths: list[tuple[array, array, float, float, float]] = []
+        self._cycle = 0.0
 
     
     def add_animations(self, animations: AnimationSequence) -> None:
@@ -104,6 +130,19 @@ class AnimatedObject:
         """
         self.animations = animations
 
+        # positions and timings are worked out once here, so each redraw only has to
+        # look up where the object should be by now. Going by the clock rather than
+        # counting redraws keeps the speed the same however fast the loop runs
+        self._paths = []
+        for animation in animations.sequence:
+            xs, ys = animation.path()
+            delay = animation.start_delay * animations.interval
+            step = animations.interval if animation.duration is None else animation.duration / len(xs)
+            self._paths.append((xs, ys, delay, step, delay + step * len(xs)))
+        self._cycle = sum(path[4] for path in self._paths)
+        self.animation_index = 0
+        self.animation_started = None
+
     def create_hotspot(self, width: int, height: int) -> snapshot:
         if self.animations is not None:
             interval = self.animations.interval
@@ -114,51 +153,39 @@ class AnimatedObject:
         return self.luma_snapshot
         
     def update(self, draw: ImageDraw.ImageDraw, width: int, height: int) -> None:
+        if self._paths:
+            self._move(time.monotonic())
+
         x_offset = 0
 
         for t in self.text:
             draw.text((x_offset + self.current_x - self.start_pos[0], self.current_y - self.start_pos[1]), t.text, font=t.font, fill="yellow")
             x_offset += int(draw.textlength(t.text, t.font))
-        
-        if self.animations is not None and len(self.animations.sequence) != 0:
-
-            current_animation = self.animations.sequence[self.animation_index]
-
-            if self.animation_counter < current_animation.start_delay:
-                self.animation_counter += 1
-                return
-            elif self.animation_counter == current_animation.start_delay:
-                self.current_x = current_animation.obj_start[0]
-                self.current_y = current_animation.obj_start[1]
-
-            delta_x = current_animation.obj_end[0] - current_animation.obj_start[0]
-            delta_y = current_animation.obj_end[1] - current_animation.obj_start[1]
 
-            # https://stackoverflow.com/a/52355075
-            sign = lambda x: -1 if x < 0 else (1 if x > 0 else 0)
+    def _move(self, now: float) -> None:
+        if self.animation_started is None:
+            self.animation_started = now
+        elapsed = now - self.animation_started
 
-            x_complete = self.current_x == current_animation.obj_end[0]
-            y_complete = self.current_y == current_animation.obj_end[1]
+        if self._cycle > 0 and elapsed >= self._cycle:
+            # after a long stall, skip whole passes of the sequence rather than play them out
+            skipped = elapsed // self._cycle * self._cycle
+            self.animation_started += skipped
+            elapsed -= skipped
 
-            # print("x", self.current_x, current_animation.obj_end[0], x_complete)
-            # print("y", self.current_y, current_animation.obj_end[1], y_complete)
+        # move on to whichever animation should be playing by now, finishing the ones passed
+        xs, ys, delay, step, length = self._paths[self.animation_index]
+        while self._cycle > 0 and elapsed >= length:
+            self.current_x, self.current_y = xs[-1], ys[-1]
+            self.animation_started += length
+            elapsed -= length
+            self.animation_index = (self.animation_index + 1) % len(self._paths)
+            xs, ys, delay, step, length = self._paths[self.animation_index]
 
-            if not x_complete:
-                self.current_x += sign(delta_x)
-
-            if not y_complete:
-                self.current_y += sign(delta_y)
-            
-            # If the animation is complete, reset the animation counter,
-            # and move on to the next animation in the sequence list
-            if x_complete and y_complete:
-                self.animation_counter = 0
-
-                self.animation_index += 1
-                self.animation_index = self.animation_index % len(self.animations.sequence)
-
-            else:
-                self.animation_counter += 1
+        # the object stays where the last animation left it until the delay is over
+        if elapsed >= delay:
+            i = min(int((elapsed - delay) / step), len(xs) - 1) if step > 0 else len(xs) - 1
+            self.current_x, self.current_y = xs[i], ys[i]
 
 
 def move_object(xy: tuple[int, int], delay: int = 0) -> Animation:
@@ -219,6 +246,66 @@ class ObjectRow:
 
 
 
+class ScrollingTicker:
+
+    def __init__(self, bitmap: Image.Image, pause_frames: int = 20, ink: int | str = "yellow") -> None:
+        """Calling-points style ticker: slides the text up into view, pauses, then scrolls it
+        left until it has gone, and repeats. Use the instance as a hotspot draw_fn.
+
+        The text is converted once into a 1-bit strip, and each frame pastes only the slice
+        of it that is visible, so the per-frame cost doesn't grow with the length of the text.
+
+        Args:
+            bitmap (Image.Image): Pre-rendered text; any non-zero pixel is lit.
+            pause_frames (int, optional): Frames to hold the text still before scrolling. Defaults to 20.
+            ink (int | str, optional): Colour to draw the text in, ideally already resolved for the
+                                       canvas mode. Defaults to "yellow".
+        """
+        self.strip = bitmap if bitmap.mode == "1" else bitmap.point(lambda p: 255 if p > 0 else 0, mode="1")
+        self.ink = ink
+        self.text_width, self.text_height = self.strip.size
+        self.pause_frames = pause_frames
+
+        # windows onto the strip, cut on first use once the hotspot width is known
+        self._window_width = None
+        self._head: Image.Image | None = None
+
+        self.reset()
+
+    def reset(self) -> None:
+        self.pixels_up = 0
+        self.pixels_left = 0
+        self.pause_count = 0
+        self.scrolling = False
+
+    def window(self, left: int, width: int) -> Image.Image:
+        """Slice of the strip starting at column left, padded with blank pixels past the end"""
+        return self.strip.crop((left, 0, left + width, self.text_height))
+
+    def __call__(self, draw: ImageDraw.ImageDraw, width: int, *_) -> None:
+        if width != self._window_width:
+            self._window_width = width
+            self._head = self.window(0, width)
+
+        if self.scrolling:
+            # slide the strip left until it's fully out of view
+            draw.bitmap((0, 0), self.window(self.pixels_left, width), fill=self.ink)
+            if self.pixels_left > self.text_width:
+                self.reset()
+            else:
+                self.pixels_left += 1
+        else:
+            # slide the strip up from the bottom of its viewport until it's fully in view
+            draw.bitmap((0, self.text_height - self.pixels_up), self._head, fill=self.ink)
+            if self.pixels_up == self.text_height:
+                self.pause_count += 1
+                if self.pause_count > self.pause_frames:
+                    self.scrolling = True
+                    self.pause_count = 0
+            else:
+                self.pixels_up += 1
+
+
 # logging
 logging.basicConfig(
     level=logging.DEBUG,
@@ -234,6 +321,8 @@ def display_settings(args):
 
     :rtype: str
     """
+    from luma.core import cmdline
+
     iface = ''
     display_types = cmdline.get_display_types()
     if args.display not in display_types['emulator']:
@@ -257,6 +346,9 @@ def get_device(actual_args=None):
     """
     Create device from command-line arguments and return it.
     """
+    # cmdline pulls in argparse and every display type, so only load it when needed
+    from luma.core import cmdline, error
+
     if actual_args is None:
         actual_args = sys.argv[1:]
     parser = cmdline.create_parser(description='luma.examples arguments')
@@ -1,25 +1,37 @@
 import os
 import sys
 import time
+import signal
+import logging
+import threading
 import json
-import requests
 import re
+import functools
 from datetime import datetime
-from PIL import ImageFont, Image, ImageDraw
-from helpers import get_device, AnimatedObject, RenderText, Animation, AnimationSequence, move_object, scroll_left, scroll_up, ObjectRow, reset_object
-from trains import loadDeparturesForStation
+from PIL import ImageFont, Image, ImageDraw, ImageColor
+from helpers import get_device, AnimatedObject, RenderText, Animation, AnimationSequence, move_object, scroll_left, scroll_up, ObjectRow, reset_object, ScrollingTicker
+import trains
+from trains import loadDeparturesForStation, loadDeparturesForStations, mergeDepartures, loadBoard, saveBoard, formatMinutes
+from fetcher import DepartureFetcher, RefreshPolicy
+from boardsnapshot import BoardSnapshotWriter, BoardSnapshotReader
+from bitmapcache import BitmapCache
+from scheduler import FrameScheduler
+from profiling import LoopProfiler, profilingRequested
+from metrics import registry, serveMetrics, writeMetricsPeriodically, FRAME_BUCKETS
 from luma.core.render import canvas
 from luma.core.virtual import viewport, snapshot
 from open import isRun
 from typing import Any, List, Tuple
 from luma.core.interface.serial import spi, noop
-from luma.oled.device import ssd1322
-from luma.core.sprite_system import framerate_regulator
-import socket, uuid
+from partialdisplay import DirtyBands, FrameDeduplicator, FastSSD1322
 
 global toc
 DISPLAY_WIDTH = 256
 DISPLAY_HEIGHT = 64
+# the panel's mode; text bitmaps are cached in it and drawn with the ink resolved once,
+# so nothing is converted or colour-parsed on each frame
+DISPLAY_MODE = "1"
+INK = ImageColor.getcolor("yellow", DISPLAY_MODE)
 
 # Constants
 HOURS_PATTERN = re.compile(r'\d{1,2}-\d{1,2}')
@@ -29,6 +41,29 @@ def loadConfig() -> dict[str, Any]:
         data = json.load(jsonConfig)
         return data
 
+def processOption(name, environment, default, argv=None):
+    # "name value" on the command line, or the environment variable, for the settings
+    # that differ between processes sharing one config.json
+    argv = sys.argv[1:] if argv is None else argv
+    if name in argv[:-1]:
+        return argv[argv.index(name) + 1]
+    return os.environ.get(environment, default)
+
+@functools.lru_cache(maxsize=64)
+def textWidth(text, font):
+    # the same few strings are measured every time a screen is built
+    return int(font.getlength(text))
+
+def secondsSinceStart():
+    # from when the process started, so interpreter startup and imports count too
+    try:
+        with open('/proc/self/stat') as stat:
+            startTicks = int(stat.read().rpartition(')')[2].split()[19])
+        with open('/proc/uptime') as uptime:
+            return float(uptime.read().split()[0]) - startTicks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
 def makeFont(name, size):
     font_path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'fonts', name))
     return ImageFont.truetype(font_path, size, layout_engine=ImageFont.Layout.BASIC)
@@ -37,8 +72,8 @@ def format_hhmm(timestamp: str) -> str:
     return f"{timestamp[0:2]}:{timestamp[2:4]}"
 
 def renderDestination(departure, font, pos):
-    departureTime = departure["aimed_departure_time"]
-    destinationName = departure["destination_name"]
+    departureTime = departure.aimed_departure_time
+    destinationName = departure.destination_name
 
     def drawText(draw, *_):
         if config["showDepartureNumbers"]:
@@ -46,104 +81,59 @@ def renderDestination(departure, font, pos):
         else:
             train = f"{departureTime}  {destinationName}"
         _, _, bitmap = cachedBitmapText(train, font)
-        draw.bitmap((0, 0), bitmap, fill="yellow")
+        draw.bitmap((0, 0), bitmap, fill=INK)
 
     return drawText
 
-def renderServiceStatus(departure):
-    def drawText(draw, width, *_):
-        train = ""
-
-        if departure["expected_departure_time"] == "On time":
-            train = "On time"
-        elif departure["expected_departure_time"] == "Cancelled":
-            train = "Cancelled"
-        elif departure["expected_departure_time"] == "Delayed":
-            train = "Delayed"
-        else:
-            if isinstance(departure["expected_departure_time"], str):
-                train = 'Exp ' + departure["expected_departure_time"]
+def serviceStatusText(departure):
+    if departure.expected_departure is None:
+        # 'On time', 'Cancelled' or 'Delayed'
+        if departure.status in ("On time", "Cancelled", "Delayed"):
+            return departure.status
+        return 'Exp ' + departure.status if departure.status else ""
+    elif departure.expected_departure == departure.aimed_departure:
+        return "On time"
+    else:
+        return 'Exp ' + formatMinutes(departure.expected_departure)
 
-            if departure["aimed_departure_time"] == departure["expected_departure_time"]:
-                train = "On time"
+def renderServiceStatus(departure):
+    train = serviceStatusText(departure)
 
+    def drawText(draw, width, *_):
         w, _, bitmap = cachedBitmapText(train, font)
-        draw.bitmap((width - w, 0), bitmap, fill="yellow")
+        draw.bitmap((width - w, 0), bitmap, fill=INK)
     return drawText
 
 def renderPlatform(departure):
     def drawText(draw, *_):
-        if "platform" in departure:
-            platform = "Plat " + departure["platform"]
-            if departure["platform"].lower() == "bus":
+        if departure.platform is not None:
+            platform = "Plat " + departure.platform
+            if departure.platform.lower() == "bus":
                 platform = "BUS"
             _, _, bitmap = cachedBitmapText(platform, font)
-            draw.bitmap((0, 0), bitmap, fill="yellow")
+            draw.bitmap((0, 0), bitmap, fill=INK)
     return drawText
 
 def renderCallingAt(draw, *_):
     stations = "Calling at: "
     _, _, bitmap = cachedBitmapText(stations, font)
-    draw.bitmap((0, 0), bitmap, fill="yellow")
+    draw.bitmap((0, 0), bitmap, fill=INK)
 
-bitmapRenderCache = {}
+bitmapRenderCache = BitmapCache(max_entries=256, max_bytes=256 * 1024, mode=DISPLAY_MODE)
+frameTime = registry.histogram("trains_frame_seconds", "Time taken by each viewport refresh", FRAME_BUCKETS)
+registry.gauge("trains_bitmap_cache_entries", "Text bitmaps cached", lambda: bitmapRenderCache.stats()['entries'])
+registry.gauge("trains_bitmap_cache_bytes", "Pixel bytes held by cached text bitmaps", lambda: bitmapRenderCache.stats()['bytes'])
+registry.gauge("trains_bitmap_cache_hit_ratio", "Share of text bitmap lookups served from the cache",
+               lambda: bitmapRenderCache.hits / max(bitmapRenderCache.hits + bitmapRenderCache.misses, 1))
+registry.gauge("trains_bitmap_cache_evictions_total", "Text bitmaps evicted from the cache",
+               lambda: bitmapRenderCache.evictions, "counter")
 
 def cachedBitmapText(text, font):
-    text = str(text)
-    nameTuple = font.getname()
-    fontKey = ''
-    for item in nameTuple:
-        fontKey = fontKey + item
-    key = text + fontKey
-    if key in bitmapRenderCache:
-        pre = bitmapRenderCache[key]
-        bitmap = pre['bitmap']
-        txt_width = pre['txt_width']
-        txt_height = pre['txt_height']
-    else:
-        _, _, txt_width, txt_height = font.getbbox(text)
-        bitmap = Image.new('L', [txt_width, txt_height], color=0)
-        pre_render_draw = ImageDraw.Draw(bitmap)
-        pre_render_draw.text((0, 0), text=text, font=font, fill=255)
-        bitmapRenderCache[key] = {'bitmap': bitmap, 'txt_width': txt_width, 'txt_height': txt_height}
-    return txt_width, txt_height, bitmap
-
-pixelsLeft = 1
-pixelsUp = 0
-hasElevated = 0
-pauseCount = 0
+    return bitmapRenderCache.get(str(text), font)
 
 def renderStations(stations):
-    def drawText(draw, *_):
-        global stationRenderCount, pauseCount, pixelsLeft, pixelsUp, hasElevated
-
-        if len(stations) == stationRenderCount - 5:
-            stationRenderCount = 0
-
-        txt_width, txt_height, bitmap = cachedBitmapText(stations, font)
-
-        if hasElevated:
-            # slide the bitmap left until it's fully out of view
-            draw.bitmap((pixelsLeft - 1, 0), bitmap, fill="yellow")
-            if -pixelsLeft > txt_width and pauseCount < 8:
-                pauseCount += 1
-                pixelsLeft = 0
-                hasElevated = 0
-            else:
-                pauseCount = 0
-                pixelsLeft = pixelsLeft - 1
-        else:
-            # slide the bitmap up from the bottom of its viewport until it's fully in view
-            draw.bitmap((0, txt_height - pixelsUp), bitmap, fill="yellow")
-            if pixelsUp == txt_height:
-                pauseCount += 1
-                if pauseCount > 20:
-                    hasElevated = 1
-                    pixelsUp = 0
-            else:
-                pixelsUp = pixelsUp + 1
-
-    return drawText
+    _, _, bitmap = cachedBitmapText(stations, font)
+    return ScrollingTicker(bitmap, ink=INK)
 
 def renderTime(draw, width, *_):
     rawTime = datetime.now().time()
@@ -151,10 +141,11 @@ def renderTime(draw, width, *_):
     w1, _, HMBitmap = cachedBitmapText("{}:{}".format(hour, minute), fontBoldLarge)
     w2, _, _ = cachedBitmapText(':00', fontBoldTall)
     _, _, SBitmap = cachedBitmapText(':{}'.format(second), fontBoldTall)
-    draw.bitmap(((width - w1 - w2) / 2, 0), HMBitmap, fill="yellow")
-    draw.bitmap((((width - w1 - w2) / 2) + w1, 5), SBitmap, fill="yellow")
+    draw.bitmap(((width - w1 - w2) / 2, 0), HMBitmap, fill=INK)
+    draw.bitmap((((width - w1 - w2) / 2) + w1, 5), SBitmap, fill=INK)
 
 def renderDebugScreen(lines):
+    # lines is a dict of cell -> text, or a function returning one to redraw live numbers
     def drawDebug(draw, *_):
         draw.rectangle((1, 1, 254, 45), outline="yellow", fill=None)
         coords = {
@@ -166,11 +157,60 @@ def renderDebugScreen(lines):
             '3B': (45, 31),
             '3C': (140, 31)
         }
-        for key, text in lines.items():
-            w, _, bitmap = cachedBitmapText(text, font)
-            draw.bitmap(coords[key], bitmap, fill="yellow")        
+        for key, text in (lines() if callable(lines) else lines).items():
+            if callable(lines):
+                # live numbers change every redraw, so keep them out of the text cache
+                draw.text(coords[key], text=text, font=font, fill="yellow")
+            else:
+                w, _, bitmap = cachedBitmapText(text, font)
+                draw.bitmap(coords[key], bitmap, fill=INK)
     return drawDebug
 
+def performanceLines(fetcher, scheduler):
+    # frame times are summarised over the time since the HUD last redrew
+    last = [frameTime.count, frameTime.sum]
+
+    def lines():
+        count, total = frameTime.count, frameTime.sum
+        frames = count - last[0]
+        meanFrame = (total - last[1]) / frames * 1000 if frames else 0
+        last[:] = count, total
+
+        if fetcher.last_fetch_ok is None and fetcher.last_board_time is None:
+            fetchResult = "waiting"
+        elif fetcher.last_fetch_ok is False:
+            # failed outright, or only the cached board could be shown
+            fetchResult = trains.lastRequestError or "failed"
+        else:
+            fetchResult = "ok"
+        boardAge = "-" if fetcher.last_board_time is None else "{:.0f}s".format(time.monotonic() - fetcher.last_board_time)
+        cache = bitmapRenderCache.stats()
+        lookups = cache['hits'] + cache['misses']
+
+        return {
+            '1A': "FPS",
+            '1B': "{:.1f}  frame {:.1f} / {:.1f} ms".format(scheduler.recent_fps(), meanFrame, frameTime.reset_peak() * 1000),
+            '2A': "Fetch",
+            '2B': "{:.2f}s {}  board {} ago".format(trains.requestLatency.last, fetchResult, boardAge),
+            '3A': "Parse",
+            '3B': "{:.1f} ms".format(trains.parseTime.last * 1000),
+            '3C': "cache {} {:.0%}".format(cache['entries'], cache['hits'] / lookups if lookups else 0)
+        }
+
+    return lines
+
+def drawDebugSignage(device, width, height, lines):
+    virtualViewport = viewport(device, width=width, height=height)
+
+    # once a second is plenty to read, and keeps the HUD itself off the frame times
+    rowDebug = snapshot(width, 46, renderDebugScreen(lines), interval=1)
+    rowTime = snapshot(width, 14, renderTime, interval=0.1)
+
+    virtualViewport.add_hotspot(rowDebug, (0, 0))
+    virtualViewport.add_hotspot(rowTime, (0, 50))
+
+    return virtualViewport
+
 def renderWelcomeTo(xOffset):
     def drawText(draw, *_):
         text = "Welcome to"
@@ -210,32 +250,90 @@ def renderDots(draw, *_):
     text = ""
     draw.text((0, 0), text=text, font=fontBold, fill="yellow")
 
-def loadData(apiConfig, journeyConfig, rows):
+def boardData(departures, stationName, fetchedAt=None):
+    # fetchedAt is when the departures were fetched, for boards that may have come from the cache
+    if departures is None:
+        return False, False, stationName, fetchedAt
+
+    firstDepartureDestinations = departures[0].calling_at_list
+    return departures, firstDepartureDestinations, stationName, fetchedAt
+
+def loadStations(journeyConfigs, apiKey, rows, displayRows=None, cachePath=None, cacheMaxAge=None):
+    # every station at once, merged into one board named after the first of them
+    boards = {}
+    failure = None
+    for journeyConfig, result, seconds in loadDeparturesForStations(journeyConfigs, apiKey, rows, displayRows):
+        if isinstance(result, ValueError):
+            raise result
+        if isinstance(result, Exception):
+            logging.warning("Failed to fetch %s from OpenLDBWS: %s", journeyConfig['departureStation'], result)
+            failure = result
+            continue
+        boards[journeyConfig["departureStation"]] = result
+
+    if not boards:
+        # serve the last good board while the API is down, as for a single station
+        cached = loadBoard(cachePath, cacheMaxAge) if cachePath else None
+        if cached is None:
+            raise failure
+        return cached
+
+    departures = mergeDepartures(i[0] for i in boards.values())
+    if departures is not None and displayRows is not None:
+        departures = departures[:displayRows]
+    first = boards.get(journeyConfigs[0]["departureStation"])
+    stationName = first[1] if first is not None else next(iter(boards.values()))[1]
+
+    if cachePath:
+        try:
+            saveBoard(cachePath, departures, stationName)
+        except OSError as err:
+            logging.warning("Failed to save departures to %s: %s", cachePath, err)
+
+    return departures, stationName, min(i[2] for i in boards.values())
+
+def loadData(apiConfig, journeyConfig, rows, displayRows=None, cachePath=None, cacheMaxAge=None):
+    import requests
+    # journeyConfig is one journey, or a list of them to show on one board
+    journeyConfigs = journeyConfig if isinstance(journeyConfig, list) else None
+    if journeyConfigs is not None:
+        journeyConfig = journeyConfigs[0]
+
     runHours = [int(x) for x in apiConfig['operatingHours'].split('-')]
     if isRun(runHours[0], runHours[1]) == False:
-        return False, False, journeyConfig['outOfHoursName']
+        return boardData(None, journeyConfig['outOfHoursName'])
 
     try:
-        departures, stationName = loadDeparturesForStation(
-            journeyConfig, apiConfig["apiKey"], rows)
-
-        if departures is None:
-            return False, False, stationName
+        if journeyConfigs is not None:
+            departures, stationName, fetchedAt = loadStations(journeyConfigs, apiConfig["apiKey"], rows, displayRows, cachePath, cacheMaxAge)
+        else:
+            departures, stationName, fetchedAt = loadDeparturesForStation(
+                journeyConfig, apiConfig["apiKey"], rows, displayRows, cachePath, cacheMaxAge)
 
-        firstDepartureDestinations = departures[0]["calling_at_list"]
-        return departures, firstDepartureDestinations, stationName
+        return boardData(departures, stationName, fetchedAt)
     except requests.RequestException as err:
-        print("Error: Failed to fetch data from OpenLDBWS")
-        print(err.__context__)
-        return False, False, journeyConfig['outOfHoursName']
+        # None leaves the board that is already up running, until the next refresh works
+        logging.warning("Failed to fetch data from OpenLDBWS: %s", err)
+        return None
+
+def publishBoard(snapshotWriter, data):
+    if snapshotWriter is not None and data is not None:
+        snapshotWriter.write(data[0] or None, data[2], data[3])
+    return data
+
+# the attribution and welcome screens never change, so each is only built once
+staticScreens = {}
 
 def drawStartup(device, width, height):
+    if ('startup', device, width, height) in staticScreens:
+        return staticScreens[('startup', device, width, height)]
+
     virtualViewport = viewport(device, width=width, height=height)
 
     with canvas(device):
-        nameSize = int(fontBold.getlength("UK Train Departure Display"))
-        poweredSize = int(fontBold.getlength("Powered by"))
-        NRESize = int(fontBold.getlength("National Rail Enquiries"))
+        nameSize = textWidth("UK Train Departure Display", fontBold)
+        poweredSize = textWidth("Powered by", fontBold)
+        NRESize = textWidth("National Rail Enquiries", fontBold)
 
         rowOne = snapshot(width, 10, renderName((width - nameSize) / 2), interval=10)
         rowThree = snapshot(width, 10, renderPoweredBy((width - poweredSize) / 2), interval=10)
@@ -249,15 +347,17 @@ def drawStartup(device, width, height):
         virtualViewport.add_hotspot(rowThree, (0, 24))
         virtualViewport.add_hotspot(rowFour, (0, 36))
 
+    staticScreens[('startup', device, width, height)] = virtualViewport
     return virtualViewport
 
 def drawBlankSignage(device, width, height, departureStation):
-    global stationRenderCount, pauseCount
+    device.clear()
 
-    welcomeSize = int(fontBold.getlength("Welcome to"))
-    stationSize = int(fontBold.getlength(departureStation))
+    if ('welcome', device, departureStation, width, height) in staticScreens:
+        return staticScreens[('welcome', device, departureStation, width, height)]
 
-    device.clear()
+    welcomeSize = textWidth("Welcome to", fontBold)
+    stationSize = textWidth(departureStation, fontBold)
 
     virtualViewport = viewport(device, width=width, height=height)
 
@@ -279,6 +379,7 @@ def drawBlankSignage(device, width, height, departureStation):
     virtualViewport.add_hotspot(rowThree, (0, 24))
     virtualViewport.add_hotspot(rowTime, (0, 50))
 
+    staticScreens[('welcome', device, departureStation, width, height)] = virtualViewport
     return virtualViewport
 
 def platform_filter(departureData, platformNumber, station):
@@ -286,59 +387,93 @@ def platform_filter(departureData, platformNumber, station):
     for sub in departureData:
         if platformNumber == "":
             platformDepartures.append(sub)
-        elif sub.get('platform') is not None:
-            if sub['platform'] == platformNumber:
+        elif sub.platform is not None:
+            if sub.platform == platformNumber:
                 res = sub
                 platformDepartures.append(res)
 
     if len(platformDepartures) > 0:
-        firstDepartureDestinations = platformDepartures[0]["calling_at_list"]
+        firstDepartureDestinations = platformDepartures[0].calling_at_list
         platformData = platformDepartures, firstDepartureDestinations, station
     else:
         platformData = platformDepartures, "", station
 
     return platformData
 
+# hotspots of the board currently on screen, keyed by (field, row), with the
+# departure details each one was drawn from; see updateSignage
+signageViewport = None
+signageHotspots = {}
+signageRows = 0
+
+ROW_POSITIONS = ['1st', '2nd', '3rd']
+
+def destinationKey(departure):
+    return (departure.service_id, departure.aimed_departure, departure.destination_name)
+
+def serviceStatusKey(departure):
+    return (departure.service_id, departure.aimed_departure, departure.expected_departure, departure.status)
+
+def platformKey(departure):
+    return (departure.service_id, departure.platform)
+
+def trackHotspot(name, hotspot, key):
+    signageHotspots[name] = [hotspot, key]
+    return hotspot
+
+def changeHotspot(name, key, makeDrawFn):
+    tracked = signageHotspots[name]
+    if tracked[1] == key:
+        return False
+
+    hotspot = tracked[0]
+    hotspot._fn = makeDrawFn()
+    # force a redraw on the next refresh, whatever the hotspot's interval
+    hotspot.last_updated = -hotspot.interval
+    tracked[1] = key
+    return True
+
 def drawSignage(device, width, height, data):
-    global stationRenderCount, pauseCount
+    global signageViewport, signageRows
 
     virtualViewport = viewport(device, width=width, height=height)
 
     status = "Exp 00:00"
     callingAt = "Calling at: "
 
-    departures, firstDepartureDestinations, departureStation = data
+    departures, firstDepartureDestinations, departureStation = data[:3]
 
-    w = int(font.getlength(callingAt))
+    w = textWidth(callingAt, font)
 
     callingWidth = w
     width = virtualViewport.width
 
     # First measure the text size
-    w = int(font.getlength(status))
-    pw = int(font.getlength("Plat 88"))
+    w = textWidth(status, font)
+    pw = textWidth("Plat 88", font)
 
     if len(departures) == 0:
         noTrains = drawBlankSignage(device, width=width, height=height, departureStation=departureStation)
         return noTrains
 
     firstFont = font
+    signageHotspots.clear()
 
-    rowOneA = snapshot(width - w - pw - 5, 10, renderDestination(departures[0], firstFont, '1st'), interval=config["refreshTime"])
-    rowOneB = snapshot(w, 10, renderServiceStatus(departures[0]), interval=10)
-    rowOneC = snapshot(pw, 10, renderPlatform(departures[0]), interval=config["refreshTime"])
+    rowOneA = trackHotspot(('destination', 0), snapshot(width - w - pw - 5, 10, renderDestination(departures[0], firstFont, '1st'), interval=config["refreshTime"]), destinationKey(departures[0]))
+    rowOneB = trackHotspot(('status', 0), snapshot(w, 10, renderServiceStatus(departures[0]), interval=10), serviceStatusKey(departures[0]))
+    rowOneC = trackHotspot(('platform', 0), snapshot(pw, 10, renderPlatform(departures[0]), interval=config["refreshTime"]), platformKey(departures[0]))
     rowTwoA = snapshot(callingWidth, 10, renderCallingAt, interval=config["refreshTime"])
-    rowTwoB = snapshot(width - callingWidth, 10, renderStations(firstDepartureDestinations), interval=0.02)
+    rowTwoB = trackHotspot(('stations', 0), snapshot(width - callingWidth, 10, renderStations(firstDepartureDestinations), interval=0.02), firstDepartureDestinations)
 
     if len(departures) > 1:
-        rowThreeA = snapshot(width - w - pw, 10, renderDestination(departures[1], font, '2nd'), interval=config["refreshTime"])
-        rowThreeB = snapshot(w, 10, renderServiceStatus(departures[1]), interval=config["refreshTime"])
-        rowThreeC = snapshot(pw, 10, renderPlatform(departures[1]), interval=config["refreshTime"])
+        rowThreeA = trackHotspot(('destination', 1), snapshot(width - w - pw, 10, renderDestination(departures[1], font, '2nd'), interval=config["refreshTime"]), destinationKey(departures[1]))
+        rowThreeB = trackHotspot(('status', 1), snapshot(w, 10, renderServiceStatus(departures[1]), interval=config["refreshTime"]), serviceStatusKey(departures[1]))
+        rowThreeC = trackHotspot(('platform', 1), snapshot(pw, 10, renderPlatform(departures[1]), interval=config["refreshTime"]), platformKey(departures[1]))
 
     if len(departures) > 2:
-        rowFourA = snapshot(width - w - pw, 10, renderDestination(departures[2], font, '3rd'), interval=10)
-        rowFourB = snapshot(w, 10, renderServiceStatus(departures[2]), interval=10)
-        rowFourC = snapshot(pw, 10, renderPlatform(departures[2]), interval=config["refreshTime"])
+        rowFourA = trackHotspot(('destination', 2), snapshot(width - w - pw, 10, renderDestination(departures[2], font, '3rd'), interval=10), destinationKey(departures[2]))
+        rowFourB = trackHotspot(('status', 2), snapshot(w, 10, renderServiceStatus(departures[2]), interval=10), serviceStatusKey(departures[2]))
+        rowFourC = trackHotspot(('platform', 2), snapshot(pw, 10, renderPlatform(departures[2]), interval=config["refreshTime"]), platformKey(departures[2]))
 
     rowTime = snapshot(width, 14, renderTime, interval=0.1)
 
@@ -346,9 +481,6 @@ def drawSignage(device, width, height, data):
         for vhotspot, xy in virtualViewport._hotspots:
             virtualViewport.remove_hotspot(vhotspot, xy)
 
-    stationRenderCount = 0
-    pauseCount = 0
-
     virtualViewport.add_hotspot(rowOneA, (0, 0))
     virtualViewport.add_hotspot(rowOneB, (width - w, 0))
     virtualViewport.add_hotspot(rowOneC, (width - w - pw, 0))
@@ -367,68 +499,249 @@ def drawSignage(device, width, height, data):
 
     virtualViewport.add_hotspot(rowTime, (0, 50))
 
-    return virtualViewport
-
-try:
-    serial = spi(port=0)
-    device = ssd1322(serial, mode="1", rotate=2)
-    config = loadConfig()
+    signageViewport = virtualViewport
+    signageRows = min(len(departures), len(ROW_POSITIONS))
 
-    font = makeFont("Dot Matrix Regular.ttf", 10)
-    fontBold = makeFont("Dot Matrix Bold.ttf", 10)
-    fontBoldTall = makeFont("Dot Matrix Bold Tall.ttf", 10)
-    fontBoldLarge = makeFont("Dot Matrix Bold.ttf", 20)
-    widgetWidth = 256
-    widgetHeight = 64
-    stationRenderCount = 0
-    pauseCount = 0
-    loop_count = 0
-
-    rows = "10"  # Define the number of rows of departure data you want to fetch
+    return virtualViewport
 
-    # Validate and parse screenBlankHours
-    blankHours = []
-    if HOURS_PATTERN.match(config['transportApi']['screenBlankHours']):
-        blankHours = [int(x) for x in config['transportApi']['screenBlankHours'].split('-')]
+def updateSignage(virtualViewport, data):
+    """Update the board drawn by drawSignage in place, repainting only the
+    hotspots whose departure details changed. Returns False when the layout
+    is different (another screen is showing, or the number of rows changed)
+    and the board has to be rebuilt with drawSignage instead."""
+    departures, firstDepartureDestinations, departureStation = data[:3]
 
-    data = loadData(config["transportApi"], config["journey"], rows)
+    shownRows = min(len(departures), len(ROW_POSITIONS))
+    if virtualViewport is not signageViewport or shownRows == 0 or shownRows != signageRows:
+        return False
 
-    if data[0] == False:
-        virtual = drawBlankSignage(
-            device, width=widgetWidth, height=widgetHeight, departureStation=data[2])
-    else:
-        virtual = drawSignage(device, width=widgetWidth,
-                              height=widgetHeight, data=data)
+    for row in range(shownRows):
+        departure = departures[row]
+        changeHotspot(('destination', row), destinationKey(departure), lambda: renderDestination(departure, font, ROW_POSITIONS[row]))
+        changeHotspot(('status', row), serviceStatusKey(departure), lambda: renderServiceStatus(departure))
+        changeHotspot(('platform', row), platformKey(departure), lambda: renderPlatform(departure))
 
-    timeAtStart = time.time()
-    timeNow = time.time()
+    # leave the scroller where it is unless there is something new to scroll
+    changeHotspot(('stations', 0), firstDepartureDestinations, lambda: renderStations(firstDepartureDestinations))
 
-    while True:
-        timeNow = time.time()
+    return True
 
-        # Check if within blank hours and clear the screen if necessary
-        if len(blankHours) == 2 and isRun(blankHours[0], blankHours[1]):
-            device.clear()  # This line clears the screen
-            time.sleep(10)  # Sleep for 10 seconds before checking again
-            continue
+def loadFonts():
+    global font, fontBold, fontBoldTall, fontBoldLarge
+    font = makeFont("Dot Matrix Regular.ttf", 10)
+    fontBold = makeFont("Dot Matrix Bold.ttf", 10)
+    fontBoldTall = makeFont("Dot Matrix Bold Tall.ttf", 10)
+    fontBoldLarge = makeFont("Dot Matrix Bold.ttf", 20)
 
-        if(timeNow - timeAtStart >= config["refreshTime"]):
-            # display NRE attribution while data loads
+# text every board draws, rendered ahead of time rather than on the first refresh
+PREWARM_TEXT = ["Calling at: ", "On time", "Cancelled", "Delayed", "Plat 1", "Plat 2"]
+
+def prewarmText():
+    # not needed for the first frame, so done straight after it
+    for cachedFont in (font, fontBoldTall, fontBoldLarge):
+        bitmapRenderCache.add_atlas(cachedFont)
+    for text in PREWARM_TEXT:
+        cachedBitmapText(text, font)
+    cachedBitmapText(":00", fontBoldTall)
+    for cachedFont, text in ((fontBold, "Welcome to"), (fontBold, "UK Train Departure Display"),
+                             (font, "Exp 00:00"), (font, "Plat 88")):
+        textWidth(text, cachedFont)
+
+def startMetrics(config, screen, role):
+    # scrape with Prometheus, or have node_exporter pick up the file
+    if config.get("metricsPort", 0):
+        # one port per process: screen N's on metricsPort + N - 1, unless a separate
+        # fetch process has metricsPort, when each display moves up one
+        serveMetrics(config["metricsPort"] + (screen if role == "display" else screen - 1))
+    if config.get("metricsFile", ""):
+        metricsPath = config["metricsFile"]
+        if role == "fetch":
+            # next to the display's file rather than over it
+            base, extension = os.path.splitext(metricsPath)
+            metricsPath = base + "-fetch" + extension
+        writeMetricsPeriodically(metricsPath, config.get("metricsInterval", 60))
+
+if __name__ == "__main__":
+    try:
+        config = loadConfig()
+
+        # journey is one journey, or a list of them fetched together and shown as one board
+        primaryJourney = config["journey"][0] if isinstance(config["journey"], list) else config["journey"]
+
+        # several processes can each drive their own screen, e.g. one per platform
+        screen = int(processOption("--screen", "TRAINS_SCREEN", 1))
+
+        rows = "10"  # Define the number of rows of departure data you want to fetch
+        displayRows = 3  # drawSignage shows three departures, so stop parsing once we have them
+
+        # --profile or TRAINS_PROFILE=1 captures cProfile slices and memory growth
+        profiler = LoopProfiler.from_environment() if profilingRequested() else None
+
+        # one process can fetch for several displays: "fetch" only writes the board to
+        # boardSnapshotFile, "display" only reads it, and by default a process does both
+        snapshotPath = config.get("boardSnapshotFile", "")
+        snapshotRole = processOption("--role", "TRAINS_ROLE", config.get("boardSnapshotRole", "")) if snapshotPath else ""
+        snapshotWriter = None
+        if snapshotPath and snapshotRole != "display":
+            snapshotWriter = BoardSnapshotWriter(snapshotPath)
+            # other displays may filter by platform, so keep every departure fetched
+            displayRows = None
+
+        # the last good board is kept on disk, to show straight away at startup
+        # and to fall back on while the API is unavailable
+        cachePath = config.get("boardCacheFile", "last-board.json")
+        cacheMaxAge = config.get("boardCacheMaxAge", 3600)
+
+        refreshInterval = config["refreshTime"]
+        refreshPolicy = None
+        if config.get("adaptiveRefresh", False):
+            # poll more often when a train is due or running late, less often when nothing changes
+            refreshPolicy = RefreshPolicy(
+                config["refreshTime"],
+                min_interval=config.get("minRefreshTime", 30),
+                max_interval=config.get("maxRefreshTime", 900),
+                hourly_budget=config.get("hourlyRequestBudget", 0),
+                request_count=lambda: trains.apiRequestCount,
+                operating_hours=tuple(int(x) for x in config["transportApi"]["operatingHours"].split('-')))
+            refreshInterval = refreshPolicy.next_interval
+            registry.gauge("trains_refresh_interval_seconds", "Wait chosen before the next refresh", lambda: refreshPolicy.interval)
+            registry.gauge("trains_request_budget_remaining", "API requests left in the hourly budget", refreshPolicy.remaining_budget)
+
+        if snapshotRole == "display":
+            fetcher = BoardSnapshotReader(
+                snapshotPath, primaryJourney.get(f"screen{screen}Platform", ""), 3, boardData)
+        else:
+            load = lambda: publishBoard(snapshotWriter, loadData(
+                config["transportApi"], config["journey"], rows, displayRows, cachePath, cacheMaxAge))
+            if profiler is not None:
+                load = profiler.wrap("fetch", load)
+            fetcher = DepartureFetcher(load, refreshInterval, fetched_at=lambda board: board[3])
+            if snapshotRole == "fetch":
+                # the API metrics are only ever seen by this process
+                startMetrics(config, screen, snapshotRole)
+                # no display to drive, so fetch in the foreground
+                fetcher.run()
+                raise fetcher.error
+
+        # screen N is on chip select N - 1 of SPI0 unless screenNSpi says otherwise
+        serial = spi(**dict({"port": 0, "device": screen - 1}, **config.get(f"screen{screen}Spi", {})))
+        # send the panel just the rows each frame changed, rather than luma's diffed quadrants
+        dirtyBands = DirtyBands() if config.get("partialUpdates", True) else None
+        # packs pixels with NumPy when it is installed, and is the stock ssd1322 when it isn't
+        device = FastSSD1322(serial, mode=DISPLAY_MODE, rotate=2, framebuffer=dirtyBands)
+        if config.get("skipIdenticalFrames", True):
+            # most refreshes leave the screen exactly as it was
+            device = FrameDeduplicator(device)
+            registry.gauge("trains_frames_sent_total", "Frames passed on to the panel", lambda: device.frames_sent, "counter")
+            registry.gauge("trains_frames_skipped_total", "Frames dropped as identical to the one before",
+                           lambda: device.frames_skipped, "counter")
+        if dirtyBands is not None:
+            registry.gauge("trains_display_bytes_total", "Pixel data and window command bytes sent to the panel",
+                           lambda: dirtyBands.bytes_sent, "counter")
+            registry.gauge("trains_display_windows_total", "Windows written to the panel", lambda: dirtyBands.windows_sent, "counter")
+
+        loadFonts()
+        widgetWidth = 256
+        widgetHeight = 64
+        loop_count = 0
+
+        # Validate and parse screenBlankHours
+        blankHours = []
+        if HOURS_PATTERN.match(config['transportApi']['screenBlankHours']):
+            blankHours = [int(x) for x in config['transportApi']['screenBlankHours'].split('-')]
+
+        cachedBoard = loadBoard(cachePath, cacheMaxAge) if cachePath else None
+        if cachedBoard is not None and cachedBoard[0] is not None:
+            virtual = drawSignage(device, width=widgetWidth, height=widgetHeight, data=boardData(*cachedBoard))
+            showingAttribution = False
+        else:
+            # display NRE attribution until the first board arrives
             virtual = drawStartup(device, width=widgetWidth, height=widgetHeight)
-            virtual.refresh()
-
-            data = loadData(config["transportApi"], config["journey"], rows)
-            if data[0] == False:
-                virtual = drawBlankSignage(
-                    device, width=widgetWidth, height=widgetHeight, departureStation=data[2])
-            else:
-                virtual = drawSignage(device, width=widgetWidth, height=widgetHeight, data=data)
-
-            timeAtStart = time.time()
-
+            showingAttribution = True
         virtual.refresh()
 
-except KeyboardInterrupt:
-    pass
-except ValueError as err:
-    print(f"Error: {err}")
+        firstFrame = secondsSinceStart()
+        if firstFrame is not None:
+            logging.info("First frame %.2fs after start", firstFrame)
+            registry.gauge("trains_time_to_first_frame_seconds", "Time from process start to the first frame", lambda: firstFrame)
+
+        # everything from here on can wait until something is on the screen
+        prewarmText()
+        if snapshotRole != "display":
+            fetcher.start()
+
+        startMetrics(config, screen, snapshotRole)
+
+        boardVersion = 0
+        scheduler = FrameScheduler(fps=config.get("maxFps", 50))
+        registry.gauge("trains_fps", "Frames drawn per second over the last minute", lambda: scheduler.fps)
+
+        # the performance HUD replaces the board while it is on; kill -USR1 toggles it
+        showDebug = config.get("debugScreen", False)
+        debugToggled = threading.Event()
+        signal.signal(signal.SIGUSR1, lambda *_: debugToggled.set())
+        debugViewport = None
+        # the board the attribution screen is covering while a fetch runs
+        coveredBoard = None
+
+        while True:
+            # Check if within blank hours and clear the screen if necessary
+            if len(blankHours) == 2 and isRun(blankHours[0], blankHours[1]):
+                device.clear()  # This line clears the screen
+                time.sleep(10)  # Sleep for 10 seconds before checking again
+                continue
+
+            if fetcher.error is not None:
+                raise fetcher.error
+
+            # read before latest(), as a fetch that has stopped has already published its board
+            fetching = fetcher.fetching
+            boardVersion, data = fetcher.latest(boardVersion)
+            if data is not None:
+                if coveredBoard is not None:
+                    # update the board under the attribution screen rather than drawing a new one
+                    virtual = coveredBoard
+                if data[0] == False:
+                    virtual = drawBlankSignage(
+                        device, width=widgetWidth, height=widgetHeight, departureStation=data[2])
+                elif not updateSignage(virtual, data):
+                    virtual = drawSignage(device, width=widgetWidth, height=widgetHeight, data=data)
+                showingAttribution = False
+                coveredBoard = None
+                if profiler is not None:
+                    profiler.memory_checkpoint()
+            elif config.get("showAttribution", False) and fetching and not showingAttribution:
+                # optionally display NRE attribution while data loads; the old board keeps running otherwise
+                coveredBoard = virtual
+                virtual = drawStartup(device, width=widgetWidth, height=widgetHeight)
+                showingAttribution = True
+            elif showingAttribution and coveredBoard is not None and not fetching:
+                # the fetch failed, so put back the board it would have replaced
+                virtual = coveredBoard
+                coveredBoard = None
+                showingAttribution = False
+
+            if debugToggled.is_set():
+                debugToggled.clear()
+                showDebug = not showDebug
+            if showDebug and debugViewport is None:
+                debugViewport = drawDebugSignage(device, width=widgetWidth, height=widgetHeight,
+                                                 lines=performanceLines(fetcher, scheduler))
+            elif not showDebug and debugViewport is not None:
+                # the board carries on from its own backing image
+                debugViewport = None
+            shown = debugViewport or virtual
+
+            if profiler is not None:
+                profiler.tick()
+
+            with frameTime.time():
+                if dirtyBands is not None:
+                    dirtyBands.begin(shown)
+                shown.refresh()
+            scheduler.wait(shown)
+
+    except KeyboardInterrupt:
+        pass
+    except ValueError as err:
+        print(f"Error: {err}")
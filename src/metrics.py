@@ -0,0 +1,215 @@
+import bisect
+import logging
+import os
+import threading
+import time
+from typing import Callable
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20)
+PARSE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+FRAME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.02, 0.04, 0.1, 0.25)
+
+
+class Histogram:
+
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...]) -> None:
+        """Cumulative histogram of durations in seconds, in the Prometheus sense
+
+        Args:
+            name (str): Metric name.
+            help (str): One line description.
+            buckets (tuple[float, ...]): Upper bounds of the buckets, in ascending order.
+        """
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.last = 0.0
+        self.peak = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.last = value
+            self.peak = max(self.peak, value)
+
+    def reset_peak(self) -> float:
+        """Get the largest value observed since the last call, and start again
+
+        Returns:
+            float: The largest value, 0 if nothing was observed.
+        """
+        with self._lock:
+            peak, self.peak = self.peak, 0.0
+            return peak
+
+    def time(self) -> "Timer":
+        """Context manager that observes how long its block took"""
+        return Timer(self)
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def mean(self) -> float:
+        count = self.count
+        return self.sum / count if count else 0.0
+
+    def exposition(self) -> list[str]:
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        cumulative += counts[-1]
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+
+class Timer:
+
+    def __init__(self, histogram: Histogram) -> None:
+        self.histogram = histogram
+
+    def __enter__(self) -> "Timer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Registry:
+
+    def __init__(self) -> None:
+        """Every metric the process exposes. Histograms are fed as things happen;
+        gauges are callbacks read only when the metrics are scraped, so they cost
+        nothing between scrapes"""
+        self.histograms: dict[str, Histogram] = {}
+        self.gauges: dict[str, tuple[str, str, Callable[[], float | None]]] = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name: str, help: str, buckets: tuple[float, ...]) -> Histogram:
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(name, help, buckets)
+            return self.histograms[name]
+
+    def gauge(self, name: str, help: str, read: Callable[[], float | None], kind: str = "gauge") -> None:
+        """Register or replace a gauge
+
+        Args:
+            name (str): Metric name.
+            help (str): One line description.
+            read (Callable[[], float | None]): Returns the current value, or None to leave it out.
+            kind (str, optional): Prometheus type, "counter" for totals that only go up. Defaults to "gauge".
+        """
+        with self._lock:
+            self.gauges[name] = (kind, help, read)
+
+    def exposition(self) -> str:
+        """The metrics in Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            histograms = list(self.histograms.values())
+            gauges = list(self.gauges.items())
+        for histogram in histograms:
+            lines.extend(histogram.exposition())
+        for name, (kind, help, read) in gauges:
+            try:
+                value = read()
+            except Exception:
+                logging.exception("Failed to read metric %s", name)
+                continue
+            if value is None:
+                continue
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def residentBytes() -> int | None:
+    # current resident set size; ru_maxrss would only give the peak
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+registry.gauge("trains_resident_memory_bytes", "Resident set size of the process", residentBytes)
+
+
+def serveMetrics(port: int, host: str = "127.0.0.1"):
+    """Serve the registry at http://host:port/metrics from a daemon thread
+
+    Args:
+        port (int): Port to listen on.
+        host (str, optional): Address to bind. Defaults to localhost only.
+
+    Returns:
+        ThreadingHTTPServer: The running server.
+    """
+    # http.server brings in the email package, so keep it off the startup path unless it is used
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self) -> None:
+            if self.path not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = registry.exposition().encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args) -> None:
+            # a scrape every few seconds would otherwise fill the log
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="MetricsServer", daemon=True).start()
+    return server
+
+
+def writeMetricsPeriodically(path: str, interval: float = 60) -> threading.Thread:
+    """Write the registry to path every interval seconds from a daemon thread, for
+    node_exporter's textfile collector or anything else that reads files
+
+    Args:
+        path (str): File to write; replaced atomically each time.
+        interval (float, optional): Seconds between writes. Defaults to 60.
+
+    Returns:
+        threading.Thread: The writer thread.
+    """
+    def write() -> None:
+        while True:
+            try:
+                tempPath = path + ".tmp"
+                with open(tempPath, 'w') as metricsFile:
+                    metricsFile.write(registry.exposition())
+                os.replace(tempPath, path)
+            except OSError as err:
+                logging.warning("Failed to write metrics to %s: %s", path, err)
+            time.sleep(interval)
+
+    thread = threading.Thread(target=write, name="MetricsWriter", daemon=True)
+    thread.start()
+    return thread
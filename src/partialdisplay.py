@@ -0,0 +1,345 @@
+import logging
+
+from PIL import Image, ImageChops
+from luma.core.virtual import viewport
+from luma.oled.device import ssd1322
+
+# SSD1322 commands that set the RAM write window and start a write
+SET_COLUMN_ADDRESS = 0x15
+SET_ROW_ADDRESS = 0x75
+WRITE_RAM = 0x5C
+# bytes of commands it takes to open a window: 0x15 and 0x75 with two arguments each, then 0x5C
+WINDOW_COST = 7
+# bands are split into columns this wide, so each part gets its own tight row range
+COLUMN_CHUNK = 64
+
+
+class DirtyBands:
+
+    def __init__(self) -> None:
+        """Framebuffer strategy for luma greyscale devices that sends the panel one
+        window per band of rows that changed, instead of diff_to_previous's fixed
+        quadrants, and only compares the rows that hotspots actually redrew
+
+        Pass an instance as the device's framebuffer, and call begin() with the
+        viewport just before each refresh so the hotspots it repaints are known.
+        Frames that weren't set up with begin(), such as device.clear(), and the
+        first frame of a different viewport, are compared row by row in full, so
+        nothing is ever missed.
+        """
+        self.prev_image: Image.Image | None = None
+        self.bytes_sent = 0
+        self.windows_sent = 0
+
+        # the viewport shown by the last frame sent, and the one begin() was called for
+        self._shown: viewport | None = None
+        self._armed: viewport | None = None
+        self._position = None
+        self._hinted = False
+        self._marks: list[tuple[int, int]] = []
+
+    def begin(self, virtual: viewport) -> None:
+        """Start tracking which rows virtual's next refresh repaints
+
+        Args:
+            virtual (viewport): Viewport about to be refreshed.
+        """
+        device = virtual._device
+        self._marks.clear()
+        # a different viewport, a moved one, or anything else displayed in
+        # between, such as device.clear(), can change every row on the panel
+        self._hinted = (virtual is self._shown and virtual._position == self._position
+                        and device.rotate in (0, 2))
+        self._armed = virtual
+        self._position = virtual._position
+
+        for hotspot, xy in virtual._hotspots:
+            if getattr(hotspot, '_dirty_bands', None) is not self:
+                self._wrap(hotspot, virtual)
+
+    def skip(self) -> None:
+        """Drop the hint from begin(), for a frame that won't be displayed after all
+
+        FrameDeduplicator calls this when it skips a frame, so the rows that frame
+        repainted aren't trusted for whatever is displayed next, such as device.clear().
+        """
+        self._armed = None
+        self._hinted = False
+        self._marks.clear()
+
+    def _wrap(self, hotspot, virtual: viewport) -> None:
+        paste_into = type(hotspot).paste_into.__get__(hotspot)
+
+        def tracked_paste_into(image, xy):
+            paste_into(image, xy)
+            self._mark(virtual, xy, hotspot.height)
+
+        hotspot.paste_into = tracked_paste_into
+        hotspot._dirty_bands = self
+
+    def _mark(self, virtual: viewport, xy: tuple[int, int], height: int) -> None:
+        device = virtual._device
+        top = xy[1] - virtual._position[1]
+        bottom = top + height
+        if device.rotate == 2:
+            top, bottom = device._h - bottom, device._h - top
+        self._marks.append((max(top, 0), min(bottom, device._h)))
+
+    def redraw(self, image: Image.Image):
+        """Work out which parts of image differ from the last frame sent
+
+        Args:
+            image (Image.Image): The frame, already rotated to the panel's orientation.
+
+        Yields:
+            tuple[Image.Image, tuple[int, int, int, int]]: Each changed region and its bounding box.
+        """
+        width, height = image.size
+        rows = list(self._marks) if self._hinted else [(0, height)]
+        self._shown, self._armed, self._hinted = self._armed, None, False
+
+        if self.prev_image is None or self.prev_image.size != image.size:
+            yield image, (0, 0, width, height)
+            self._sent((0, 0, width, height))
+            self.prev_image = image.copy()
+            return
+
+        diff = ImageChops.difference(self.prev_image, image)
+        changed = False
+        for box in self._bands(diff, rows, width):
+            changed = True
+            yield image.crop(box), box
+            self._sent(box)
+
+        if changed:
+            self.prev_image = image.copy()
+
+    def _bands(self, diff: Image.Image, rows: list[tuple[int, int]], width: int):
+        # runs of rows that changed; a gap of even one unchanged row is worth a new
+        # window, which costs 7 bytes of commands against half a byte per pixel
+        changedRows = sorted({
+            y for top, bottom in rows for y in range(top, bottom)
+            if diff.crop((0, y, width, y + 1)).getbbox() is not None
+        })
+
+        band = None
+        for y in changedRows:
+            if band is not None and y == band[1]:
+                band[1] = y + 1
+            else:
+                if band is not None:
+                    yield from self._windows(diff, band)
+                band = [y, y + 1]
+        if band is not None:
+            yield from self._windows(diff, band)
+
+    def _windows(self, diff: Image.Image, band: list[int]):
+        # the changes in each column chunk of the band, merged with the chunk
+        # before whenever one bigger window costs fewer bytes than two
+        boxes = []
+        for x in range(0, diff.width, COLUMN_CHUNK):
+            bbox = diff.crop((x, band[0], min(x + COLUMN_CHUNK, diff.width), band[1])).getbbox()
+            if bbox is None:
+                continue
+            box = (x + bbox[0], band[0] + bbox[1], x + bbox[2], band[0] + bbox[3])
+            if boxes:
+                merged = (boxes[-1][0], min(boxes[-1][1], box[1]), box[2], max(boxes[-1][3], box[3]))
+                if self._cost(merged) <= self._cost(boxes[-1]) + self._cost(box):
+                    boxes[-1] = merged
+                    continue
+            boxes.append(box)
+        return boxes
+
+    def _cost(self, box: tuple[int, int, int, int]) -> int:
+        # after the device rounds the window out to whole 4 pixel column addresses
+        left, top, right, bottom = box
+        return WINDOW_COST + (-(-right // 4) * 4 - (left & ~3)) * (bottom - top) // 2
+
+    def _sent(self, box: tuple[int, int, int, int]) -> None:
+        self.windows_sent += 1
+        self.bytes_sent += self._cost(box)
+
+
+class CaptureSerial:
+
+    def __init__(self, width: int = 256, height: int = 64) -> None:
+        """Stand-in for luma's spi interface that records what would go over the wire,
+        and plays the SSD1322's windowed writes into a copy of its display RAM,
+        so partial updates can be checked without a panel
+
+        Args:
+            width (int, optional): Panel width in pixels. Defaults to 256.
+            height (int, optional): Panel height in pixels. Defaults to 64.
+        """
+        self.width = width
+        self.height = height
+        self.column_offset = (480 - width) // 2
+        self.command_bytes = 0
+        self.data_bytes = 0
+        self.ram = bytearray(480 * 128 // 2)
+
+        self._last_command = None
+        self._columns = (0, 119)
+        self._rows = (0, 127)
+        self._cursor = None
+
+    def command(self, *cmd: int) -> None:
+        self.command_bytes += len(cmd)
+        self._last_command = cmd[0]
+        if cmd[0] == WRITE_RAM:
+            self._cursor = (self._columns[0], self._rows[0], 0)
+
+    def data(self, data: list[int]) -> None:
+        self.data_bytes += len(data)
+        if self._last_command == SET_COLUMN_ADDRESS:
+            self._columns = (data[0], data[1])
+        elif self._last_command == SET_ROW_ADDRESS:
+            self._rows = (data[0], data[1])
+        elif self._last_command == WRITE_RAM and self._cursor is not None:
+            self._write(data)
+
+    def _write(self, data: list[int]) -> None:
+        # each column address holds 4 pixels in 2 bytes; the window fills row by row
+        column, row, byte = self._cursor
+        for value in data:
+            self.ram[(row * 120 + column) * 2 + byte] = value
+            byte += 1
+            if byte == 2:
+                byte = 0
+                column += 1
+                if column > self._columns[1]:
+                    column = self._columns[0]
+                    row += 1
+        self._cursor = (column, row, byte)
+
+    def cleanup(self) -> None:
+        pass
+
+    def frame(self) -> Image.Image:
+        """The visible part of display RAM, as a 4-bit greyscale image scaled to 8 bits"""
+        image = Image.new('L', (self.width, self.height))
+        pixels = []
+        for row in range(self.height):
+            start = (row * 120 + self.column_offset // 4) * 2
+            for value in self.ram[start:start + self.width // 2]:
+                pixels.append((value >> 4) * 17)
+                pixels.append((value & 0x0F) * 17)
+        image.putdata(pixels)
+        return image
+
+
+class FrameDeduplicator:
+
+    def __init__(self, device) -> None:
+        """Wraps a luma device and drops frames identical to the last one displayed,
+        before the device rotates, diffs, packs or sends anything
+
+        Most refreshes change nothing on screen: the clock redraws ten times a second
+        but only changes once, and the scroller sits still while it pauses. Frames are
+        compared byte for byte, which for a 2 KiB mode "1" frame costs about the same
+        as hashing it and can never mistake a changed frame for an old one.
+
+        Everything other than display() and clear() is passed straight to the device,
+        so it can be handed to viewport() and canvas() in the device's place.
+
+        Args:
+            device: The luma device to display frames on.
+        """
+        self.device = device
+        self.frames_sent = 0
+        self.frames_skipped = 0
+        self._last = None
+
+    def __getattr__(self, name: str):
+        return getattr(self.device, name)
+
+    def display(self, image: Image.Image) -> None:
+        frame = (image.mode, image.size, image.tobytes())
+        if frame == self._last:
+            self.frames_skipped += 1
+            # the framebuffer never sees this frame, so it mustn't keep a hint armed for it
+            skip = getattr(getattr(self.device, 'framebuffer', None), 'skip', None)
+            if skip is not None:
+                skip()
+            return
+        self._last = frame
+        self.frames_sent += 1
+        self.device.display(image)
+
+    def clear(self) -> None:
+        # goes through display() so the blank frame is remembered like any other
+        self.display(Image.new(self.device.mode, self.device.size))
+
+
+class FastSSD1322(ssd1322):
+
+    def __init__(self, serial_interface=None, **kwargs) -> None:
+        """ssd1322 that turns each changed region into the panel's packed 4 bits per pixel
+        with NumPy, rather than luma's loop over every pixel in Python
+
+        Quantising ("1": lit or not, RGB: luma's integer luma weights) and packing two
+        pixels to a byte are done on whole arrays, and the commands and data sent are
+        byte for byte what the stock driver sends. Rotation stays with preprocess(),
+        which is already done in C by Pillow, because the framebuffer strategies diff
+        the rotated image. Without NumPy installed it behaves exactly like ssd1322.
+
+        NumPy is imported after the first frame has gone out rather than here, so it
+        never holds up getting the board on screen; until then, and for the clear()
+        the constructor does, frames go through the stock driver.
+
+        Takes the same arguments as luma's ssd1322.
+        """
+        self._numpy = None
+        # the constructor's clear() isn't the first frame
+        self._loaded = True
+        super().__init__(serial_interface, **kwargs)
+        self._loaded = False
+
+    @property
+    def vectorised(self) -> bool | None:
+        """Whether frames are packed with NumPy, or None until the first frame has been shown"""
+        return self._numpy is not None if self._loaded else None
+
+    def display(self, image: Image.Image) -> None:
+        if self._numpy is None:
+            super().display(image)
+            if not self._loaded:
+                self._load()
+            return
+
+        assert image.mode == self.mode
+        assert image.size == self.size
+
+        image = self.preprocess(image)
+
+        for _, bounding_box in self.framebuffer.redraw(image):
+            left, top, right, bottom = self._inflate_bbox(bounding_box)
+            segment = image.crop((left, top, right, bottom))
+            self._set_position(top, right, bottom, left)
+            self.data(self._pack(segment).tolist())
+
+    def _load(self) -> None:
+        self._loaded = True
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        self._numpy = numpy
+        logging.info("Packing frames with %s", "NumPy" if numpy is not None else "luma's pixel loop")
+
+    def _pack(self, segment: Image.Image):
+        np = self._numpy
+        if self.mode == "1":
+            # any non-zero pixel is lit at full brightness
+            levels = np.asarray(segment, dtype=np.uint8) * 15
+        else:
+            rgb = np.asarray(segment, dtype=np.uint32)
+            levels = ((rgb[..., 0] * 306 + rgb[..., 1] * 601 + rgb[..., 2] * 117) >> 14).astype(np.uint8)
+
+        # rows are whole column addresses wide, so pixels pair up across the flattened segment
+        levels = levels.reshape(-1)
+        if self._nibble_order == 0:
+            high, low = levels[0::2], levels[1::2]
+        else:
+            high, low = levels[1::2], levels[0::2]
+        return (high << 4) | low
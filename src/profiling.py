@@ -0,0 +1,181 @@
+import cProfile
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Any, Callable
+
+# a stray import of tracemalloc or the profiler itself would otherwise top every diff
+IGNORED_TRACES = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>")
+)
+
+
+def profilingRequested(argv: list[str] | None = None) -> bool:
+    """Whether profiling was asked for with --profile or TRAINS_PROFILE=1"""
+    argv = sys.argv[1:] if argv is None else argv
+    return "--profile" in argv or os.environ.get("TRAINS_PROFILE", "") not in ("", "0")
+
+
+class LoopProfiler:
+
+    def __init__(self, directory: str = "profiles", window: float = 30, every: float = 300,
+                 trace_memory: bool = True, top: int = 10) -> None:
+        """Profiles slices of the render loop and the fetch path, and diffs memory
+        between boards, for finding stutters and leaks on a running display
+
+        cProfile only runs for window seconds at the start of each every seconds, and the
+        stats for each slice are dumped to a pstats file in directory, to open with
+        python -m pstats or snakeviz. luma paints hotspots on its own thread pool, so
+        while a window is open every task the pool runs is profiled as well, and
+        merged into the same file as the render loop. Nothing is created unless profiling is asked for,
+        so the render loop only pays for an "is None" check when it is off.
+
+        Args:
+            directory (str, optional): Where to write the pstats files. Defaults to "profiles".
+            window (float, optional): Seconds of the render loop to capture at a time. Defaults to 30.
+            every (float, optional): Seconds between the start of one capture and the next. Defaults to 300.
+            trace_memory (bool, optional): Also diff tracemalloc snapshots between boards. Defaults to True.
+            top (int, optional): Call sites to log from each memory diff. Defaults to 10.
+        """
+        self.directory = directory
+        self.window = window
+        self.every = every
+        self.top = top
+        os.makedirs(directory, exist_ok=True)
+
+        self._render: cProfile.Profile | None = None
+        self._render_started = 0.0
+        # one profile per luma pool thread, by thread id
+        self._painters: dict[int, cProfile.Profile] = {}
+        self._next_window = time.monotonic()
+        self._fetch: dict[str, tuple[float, cProfile.Profile]] = {}
+        self._lock = threading.Lock()
+
+        self._snapshot = None
+        if trace_memory:
+            tracemalloc.start()
+            self._snapshot = tracemalloc.take_snapshot().filter_traces(IGNORED_TRACES)
+
+    @classmethod
+    def from_environment(cls) -> "LoopProfiler":
+        return cls(
+            directory=os.environ.get("TRAINS_PROFILE_DIR", "profiles"),
+            window=float(os.environ.get("TRAINS_PROFILE_WINDOW", 30)),
+            every=float(os.environ.get("TRAINS_PROFILE_EVERY", 300)),
+            trace_memory=os.environ.get("TRAINS_PROFILE_MEMORY", "1") != "0"
+        )
+
+    def tick(self) -> None:
+        """Call once per pass of the render loop to start and end capture windows"""
+        now = time.monotonic()
+        if self._render is None:
+            if now >= self._next_window:
+                self._render = self._enable()
+                self._render_started = now
+                self._next_window = now + self.every
+                if self._render is not None:
+                    self._profile_pool(True)
+        elif now - self._render_started >= self.window:
+            # tick() is called between refreshes, so no hotspot is being painted
+            self._render.disable()
+            self._profile_pool(False)
+            stats = pstats.Stats(self._render)
+            for profile in self._painters.values():
+                stats.add(profile)
+            self._painters.clear()
+            self._dump("render", stats)
+            self._render = None
+
+    def wrap(self, name: str, fn: Callable[..., Any]) -> Callable[..., Any]:
+        """Profile every call to fn, e.g. the fetcher's load, and dump what has been
+        gathered each time the every interval has gone by
+
+        Args:
+            name (str): Prefix for the pstats files.
+            fn (Callable[..., Any]): Function to profile; always called from the same thread.
+
+        Returns:
+            Callable[..., Any]: fn, profiled.
+        """
+        def profiled(*args, **kwargs):
+            started, profile = self._fetch.get(name) or (time.monotonic(), cProfile.Profile())
+            enabled = self._enable(profile) is not None
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                if enabled:
+                    profile.disable()
+                if time.monotonic() - started >= self.every:
+                    self._dump(name, profile)
+                    self._fetch.pop(name, None)
+                else:
+                    self._fetch[name] = (started, profile)
+
+        return profiled
+
+    def memory_checkpoint(self) -> None:
+        """Log the call sites whose allocations grew the most since the last checkpoint,
+        e.g. each time a new board is drawn"""
+        if self._snapshot is None:
+            return
+        snapshot = tracemalloc.take_snapshot().filter_traces(IGNORED_TRACES)
+        growth = [i for i in snapshot.compare_to(self._snapshot, 'lineno') if i.size_diff > 0][:self.top]
+        self._snapshot = snapshot
+
+        current, peak = tracemalloc.get_traced_memory()
+        logging.info("Traced memory %.1f KiB (peak %.1f KiB), largest growth since the last board:",
+                     current / 1024, peak / 1024)
+        for stat in growth:
+            logging.info("  %s", stat)
+
+    def _profile_pool(self, on: bool) -> None:
+        # viewport.refresh() hands each hotspot's paste_into to luma's pool, where
+        # the main thread's profile can't see it
+        from luma.core.virtual import pool
+
+        if not on:
+            pool.__dict__.pop("add_task", None)
+            return
+
+        add_task = type(pool).add_task.__get__(pool)
+
+        def profiled(func, *args, **kwargs):
+            profile = self._painters.get(threading.get_ident())
+            if profile is None:
+                profile = self._painters.setdefault(threading.get_ident(), cProfile.Profile())
+            # from Python 3.12 the main thread's profile already covers every thread
+            enabled = self._enable(profile) is not None
+            try:
+                func(*args, **kwargs)
+            finally:
+                if enabled:
+                    profile.disable()
+
+        pool.add_task = lambda func, *args, **kwargs: add_task(profiled, func, *args, **kwargs)
+
+    def _enable(self, profile: cProfile.Profile | None = None) -> cProfile.Profile | None:
+        profile = profile or cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # from Python 3.12 only one profiler can be active at once
+            logging.debug("Skipping profile, another is already running")
+            return None
+        return profile
+
+    def _dump(self, name: str, profile: cProfile.Profile | pstats.Stats) -> None:
+        path = os.path.join(self.directory, "{}-{}.pstats".format(name, time.strftime("%Y%m%d-%H%M%S")))
+        with self._lock:
+            try:
+                profile.dump_stats(path)
+            except OSError as err:
+                logging.warning("Failed to write profile to %s: %s", path, err)
+                return
+        logging.info("Wrote profile %s", path)
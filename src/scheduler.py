@@ -0,0 +1,83 @@
+import logging
+import time
+
+from luma.core.virtual import viewport
+
+
+class FrameScheduler:
+
+    def __init__(self, fps: float = 50, max_sleep: float = 1.0, report_interval: float = 60) -> None:
+        """Sleeps the render loop until the next hotspot is due to redraw, instead of
+        refreshing the viewport back to back
+
+        Args:
+            fps (float, optional): Frame rate cap; 0 for no cap. Defaults to 50, the scroller's 0.02 s interval.
+            max_sleep (float, optional): Longest single sleep, so the loop still picks up new boards
+                                         and blank hours promptly. Defaults to 1.0.
+            report_interval (float, optional): Seconds between frame rate log lines; 0 to disable. Defaults to 60.
+        """
+        self.target_fps = fps
+        self.min_frame_time = 1.0 / fps if fps > 0 else 0
+        self.max_sleep = max_sleep
+        self.report_interval = report_interval
+
+        self.frames = 0
+        self.fps = 0.0
+        self.sleep_time = 0.0
+        self.start_time = time.perf_counter()
+        self.last_frame = self.start_time
+        self.frame_start = self.start_time
+        self._report_frames = 0
+        self._report_time = self.start_time
+
+    def next_deadline(self, virtual: viewport) -> float:
+        """Work out when the next hotspot wants redrawing
+
+        Args:
+            virtual (viewport): Viewport whose hotspots to check.
+
+        Returns:
+            float: perf_counter() time of the earliest redraw.
+        """
+        deadline = self.last_frame + self.max_sleep
+        for hotspot, _ in virtual._hotspots:
+            interval = getattr(hotspot, 'interval', None)
+            if interval is None:
+                # plain hotspots redraw on every refresh
+                return self.last_frame
+            deadline = min(deadline, hotspot.last_updated + interval)
+        return deadline
+
+    def wait(self, virtual: viewport) -> None:
+        """Record a frame and sleep until the next one is due
+
+        Args:
+            virtual (viewport): Viewport that has just been refreshed.
+        """
+        now = time.perf_counter()
+        self.frames += 1
+        self._report_frames += 1
+        self.last_frame = now
+
+        deadline = max(self.next_deadline(virtual), self.frame_start + self.min_frame_time)
+        sleep_for = deadline - time.perf_counter()
+        if sleep_for > 0:
+            # snapshots only redraw once strictly past their interval
+            time.sleep(sleep_for + 0.0005)
+            self.sleep_time += sleep_for
+        self.frame_start = time.perf_counter()
+
+        if self.report_interval > 0 and now - self._report_time >= self.report_interval:
+            self.fps = self._report_frames / (now - self._report_time)
+            logging.info("%.1f fps (target %s)", self.fps, self.target_fps)
+            self._report_frames = 0
+            self._report_time = now
+
+    def recent_fps(self) -> float:
+        """Frame rate since the last log line, or the last report if one has only just been logged"""
+        elapsed = time.perf_counter() - self._report_time
+        return self._report_frames / elapsed if elapsed >= 1 else self.fps
+
+    def effective_fps(self) -> float:
+        elapsed = time.perf_counter() - self.start_time
+        return self.frames / elapsed if elapsed > 0 else 0.0
@@ -1,11 +1,17 @@
-import requests
 import re
 import json  # Ensure this line is included
-import xmltodict
-from datetime import date
-from dataclasses import dataclass
+import io
+import string
+import functools
+import threading
+import os
+import time
+import logging
+from datetime import date, datetime
+from dataclasses import dataclass, astuple, field
 from typing import Any, List, Tuple
 import xml.etree.ElementTree as ET
+from metrics import registry, LATENCY_BUCKETS, PARSE_BUCKETS
 
 def loadConfig():
     with open('config.json', 'r') as json_file:
@@ -18,6 +24,58 @@ def isTime(value):
     matches = re.findall(r"\d{2}:\d{2}", value)
     return len(matches) > 0
 
+TIME_PATTERN = re.compile(r"(\d{2}):(\d{2})")
+
+def parseMinutes(value):
+    # 'HH:MM' -> minutes since midnight, or None for 'On time', 'Cancelled' etc.
+    if value is None:
+        return None
+    match = TIME_PATTERN.search(value)
+    if match is None:
+        return None
+    return int(match.group(1)) * 60 + int(match.group(2))
+
+def formatMinutes(minutes):
+    return f"{minutes // 60 % 24:02d}:{minutes % 60:02d}"
+
+@dataclass(slots=True)
+class CallingPoint:
+    location_name: str
+    crs: str | None
+    scheduled: int | None           # minutes since midnight
+    expected: int | None            # minutes since midnight, if the estimate (or actual) is a time
+    status: str | None              # the estimate if it isn't a time: 'On time', 'Cancelled', 'Delayed'
+
+@dataclass(slots=True)
+class Departure:
+    service_id: str | None
+    aimed_departure: int            # minutes since midnight
+    expected_departure: int | None  # minutes since midnight, if the estimate is a time
+    status: str | None              # the estimate if it isn't a time: 'On time', 'Cancelled', 'Delayed'
+    platform: str | None
+    operator: str | None
+    carriages: int
+    destination_name: str
+    calling_points: list[list[CallingPoint]] | None  # one list per portion of a splitting train, None if not known
+    show_individual_departure_time: bool
+    # the scroller text, only built for departures that are actually shown; see calling_at_list
+    _calling_at_list: str | None = field(default=None, repr=False, compare=False)
+
+    @property
+    def calling_at_list(self):
+        if self._calling_at_list is None:
+            self._calling_at_list = prepareCallingAtList(self, self.show_individual_departure_time)
+        return self._calling_at_list
+
+    @property
+    def aimed_departure_time(self):
+        return formatMinutes(self.aimed_departure)
+
+    @property
+    def departure_time(self):
+        # when the train is expected to leave, falling back to when it is scheduled to
+        return self.expected_departure if self.expected_departure is not None else self.aimed_departure
+
 def joinwithCommas(listIN):
     return ", ".join(listIN)[::-1].replace(",", "dna ", 1)[::-1]
 
@@ -35,205 +93,531 @@ def prepareServiceMessage(operator):
     return joinWithSpaces("A" if operator not in ['Elizabeth Line', 'Avanti West Coast'] else "An", operator, "Service")
 
 def prepareLocationName(location, show_departure_time):
-    location_name = removeBrackets(location['lt7:locationName'])
-
     if not show_departure_time:
-        return location_name
+        return location.location_name
     else:
-        scheduled_time = location["lt7:st"]
-        try:
-            expected_time = location["lt7:et"]
-        except KeyError:
-            # as per api docs, it's 'at' if there isn't an 'et':
-            expected_time = location["lt7:at"]
-        departure_time = expected_time if isTime(expected_time) else scheduled_time
-        formatted_departure = joinWith(["(", departure_time, ")"], "")
-        return joinWithSpaces(location_name, formatted_departure)
+        departure_time = location.expected if location.expected is not None else location.scheduled
+        formatted_departure = joinWith(["(", formatMinutes(departure_time), ")"], "")
+        return joinWithSpaces(location.location_name, formatted_departure)
 
 def prepareCarriagesMessage(carriages):
     if carriages == 0:
         return ""
     else:
-        return joinWithSpaces("formed of", carriages, "coaches.")
-
-def ArrivalOrder(ServicesIN):
-    ServicesOUT = []
-    for servicenum, eachService in enumerate(ServicesIN):
-        STDHour = int(eachService['lt4:std'][0:2])
-        STDMinute = int(eachService['lt4:std'][3:5])
-        if (STDHour < 2): 
-            STDHour += 24 # this prevents a 12am departure displaying before a 11pm departure
-        STDinMinutes = STDHour*60 + STDMinute # this service is at this many minutes past midnight
-        ServicesOUT.append(eachService)
-        ServicesOUT[servicenum]['sortOrder'] = STDinMinutes
-    ServicesOUT = sorted(ServicesOUT, key=lambda k: k['sortOrder'])
-    return ServicesOUT
-
-
-def ProcessDepartures(journeyConfig, APIOut):
+        return joinWithSpaces("formed of", str(carriages), "coaches.")
+
+def departureSortOrder(departure):
+    STDinMinutes = departure.aimed_departure # this service is at this many minutes past midnight
+    if STDinMinutes < 2 * 60:
+        STDinMinutes += 24 * 60 # this prevents a 12am departure displaying before a 11pm departure
+    return STDinMinutes
+
+def ArrivalOrder(DeparturesIN):
+    return sorted(DeparturesIN, key=departureSortOrder)
+
+def localName(tag):
+    # '{http://thalesgroup.com/RTTI/2015-11-27/ldb/types}std' -> 'std'
+    return tag.rpartition('}')[2]
+
+def childText(element, name):
+    for child in element:
+        if localName(child.tag) == name:
+            return child.text
+    return None
+
+def childrenNamed(element, name):
+    return [child for child in element if localName(child.tag) == name]
+
+def elementFields(element):
+    # flatten a leaf-only element such as a callingPoint into {localName: text}
+    return {localName(child.tag): child.text for child in element}
+
+def prepareCallingPoint(element):
+    fields = elementFields(element)
+    # as per api docs, it's 'at' if there isn't an 'et'
+    estimate = fields.get("et", fields.get("at"))
+    expected = parseMinutes(estimate)
+    return CallingPoint(
+        location_name=removeBrackets(fields["locationName"]),
+        crs=fields.get("crs"),
+        scheduled=parseMinutes(fields.get("st")),
+        expected=expected,
+        status=estimate if expected is None else None
+    )
+
+def iterBoard(APIOut):
+    """Stream a GetDepBoardWithDetails (or GetDepartureBoard) response.
+
+    Yields ('locationName', name) for the departure station, then
+    (section, serviceElement) for each service in 'trainServices' or
+    'busServices'. Each service element is cleared once the caller has
+    consumed it, so only one service is held in memory at a time.
+    """
+    if isinstance(APIOut, str):
+        APIOut = APIOut.encode('utf-8')
+
+    section = None
+    container = None
+    serviceDepth = 0
+    haveStationName = False
+
+    for event, element in ET.iterparse(io.BytesIO(APIOut), events=('start', 'end')):
+        name = localName(element.tag)
+
+        if event == 'start':
+            if name in ('trainServices', 'busServices', 'ferryServices'):
+                section = name
+                container = element
+            elif name == 'service':
+                serviceDepth += 1
+            continue
+
+        if name == 'service':
+            serviceDepth -= 1
+            if serviceDepth == 0:
+                if section != 'ferryServices':
+                    yield section, element
+                element.clear()
+                container.remove(element)
+        elif name == 'locationName' and serviceDepth == 0 and not haveStationName:
+            haveStationName = True
+            yield name, element.text
+
+def prepareDestinationName(service):
+    destination = childrenNamed(service, 'destination')[0]
+    # the service splits if it has multiple destinations
+    DestinationList = [childText(i, 'locationName') for i in childrenNamed(destination, 'location')]
+    return " & ".join([removeBrackets(i) for i in DestinationList])
+
+def prepareCallingAtList(departure, show_individual_departure_time):
+    if departure.calling_points is None:
+        # they weren't fetched, or fetching them failed, so don't claim the train runs non-stop
+        return joinWithSpaces(
+            prepareServiceMessage(departure.operator),
+            prepareCarriagesMessage(departure.carriages)
+        )
+    elif departure.calling_points:  # there are some calling points
+        if len(departure.calling_points) > 1:
+            # there are multiple lists of calling points (the train splits)
+            CallListJoined = []
+            for eachSection in departure.calling_points:
+                CallListJoined.append(joinwithCommas([prepareLocationName(i, show_individual_departure_time) for i in eachSection]))
+            return joinWithSpaces(
+                " with a portion going to ".join(CallListJoined),
+                "  --  ",
+                prepareServiceMessage(departure.operator),
+                prepareCarriagesMessage(departure.carriages)
+            )
+
+        elif len(departure.calling_points[0]) == 1:
+            # there is only one calling point in the list
+            return joinWithSpaces(
+                prepareLocationName(departure.calling_points[0][0], show_individual_departure_time),
+                "only.",
+                "  --  ",
+                prepareServiceMessage(departure.operator),
+                prepareCarriagesMessage(departure.carriages)
+            )
+        else:  # there are several calling points in the list
+            CallList = [prepareLocationName(i, show_individual_departure_time) for i in departure.calling_points[0]]
+            return joinWithSpaces(
+                joinwithCommas(CallList) + ".",
+                " --  ",
+                prepareServiceMessage(departure.operator),
+                prepareCarriagesMessage(departure.carriages)
+            )
+    else:  # there are no calling points, so just display the destination
+        return joinWithSpaces(
+            departure.destination_name,
+            "only.",
+            prepareServiceMessage(departure.operator),
+            prepareCarriagesMessage(departure.carriages)
+        )
+
+def prepareDeparture(service, show_individual_departure_time):
+    # get estimated departure time: either a time, or 'On time', 'Cancelled', 'Delayed'
+    etd = childText(service, 'etd')
+    expected = parseMinutes(etd)
+
+    # get carriages, if available
+    carriages = childText(service, 'length')
+
+    # get calling points, one list per portion of the train (the train splits if there is more than one)
+    subsequentCallingPoints = childrenNamed(service, 'subsequentCallingPoints')
+    CallingPoints = []
+    if subsequentCallingPoints:
+        CallingPoints = [
+            [prepareCallingPoint(i) for i in childrenNamed(eachSection, 'callingPoint')]
+            for eachSection in childrenNamed(subsequentCallingPoints[0], 'callingPointList')
+        ]
+
+    return Departure(
+        # the service's unique id, used to tell boards apart between refreshes
+        service_id=childText(service, 'serviceID'),
+        aimed_departure=parseMinutes(childText(service, 'std')),
+        expected_departure=expected,
+        status=etd if expected is None else None,
+        platform=childText(service, 'platform'),
+        operator=childText(service, 'operator'),
+        carriages=int(carriages) if carriages else 0,
+        destination_name=prepareDestinationName(service),
+        calling_points=CallingPoints,
+        show_individual_departure_time=show_individual_departure_time
+    )
+
+
+def ProcessDepartures(journeyConfig, APIOut, maxDepartures=None):
     show_individual_departure_time = journeyConfig["individualStationDepartureTime"]
-    APIElements = xmltodict.parse(APIOut)
-    Services = []
-
-    # get departure station name
-    departureStationName = APIElements['soap:Envelope']['soap:Body']['GetDepBoardWithDetailsResponse']['GetStationBoardResult']['lt4:locationName']
-
-    # if there are only train services from this station
-    if 'lt7:trainServices' in APIElements['soap:Envelope']['soap:Body']['GetDepBoardWithDetailsResponse']['GetStationBoardResult']:
-        Services = APIElements['soap:Envelope']['soap:Body']['GetDepBoardWithDetailsResponse']['GetStationBoardResult']['lt7:trainServices']['lt7:service']
-        if isinstance(Services, dict):  # if there's only one service, it comes out as a dict
-            Services = [Services]       # but it needs to be a list with a single element
-
-        # if there are train and bus services from this station
-        if 'lt7:busServices' in APIElements['soap:Envelope']['soap:Body']['GetDepBoardWithDetailsResponse']['GetStationBoardResult']:
-            BusServices = APIElements['soap:Envelope']['soap:Body']['GetDepBoardWithDetailsResponse']['GetStationBoardResult']['lt7:busServices']['lt7:service']
-            if isinstance(BusServices, dict):
-                BusServices = [BusServices]
-            Services = ArrivalOrder(Services + BusServices)  # sort the bus and train services into one list in order of scheduled arrival time
-
-    # if there are only bus services from this station
-    elif 'lt7:busServices' in APIElements['soap:Envelope']['soap:Body']['GetDepBoardWithDetailsResponse']['GetStationBoardResult']:
-        Services = APIElements['soap:Envelope']['soap:Body']['GetDepBoardWithDetailsResponse']['GetStationBoardResult']['lt7:busServices']['lt7:service']
-        if isinstance(Services, dict):
-            Services = [Services]
+    departureStationName = None
+    Departures = []
+    BusDepartures = []
+
+    # the response lists all train services before any bus services, so once we
+    # have enough trains only the buses can still change what is shown
+    for section, value in iterBoard(APIOut):
+        if section == 'locationName':
+            departureStationName = value
+        elif section == 'busServices':
+            BusDepartures.append(prepareDeparture(value, show_individual_departure_time))
+            if maxDepartures is not None and len(BusDepartures) >= maxDepartures:
+                break
+        elif maxDepartures is None or len(Departures) < maxDepartures:
+            Departures.append(prepareDeparture(value, show_individual_departure_time))
+
+    if Departures and BusDepartures:
+        # sort the bus and train services into one list in order of scheduled departure time
+        Departures = ArrivalOrder(Departures + BusDepartures)
+    elif BusDepartures:
+        # there are only bus services from this station
+        Departures = BusDepartures
 
     # if there are no trains or buses
-    else:
-        Services = None
+    if not Departures:
         return None, departureStationName
 
-    # we create a new list of dicts to hold the services
-    Departures = [{}] * len(Services)
-
-    for servicenum, eachService in enumerate(Services):
-        thisDeparture = {}  # create empty dict to populate
-
-        # next we move elements of dict eachService to dict thisDeparture one by one
-
-        # get platform, if available
-        if 'lt4:platform' in eachService:
-            thisDeparture["platform"] = (eachService['lt4:platform'])
-
-        # get scheduled departure time
-        thisDeparture["aimed_departure_time"] = eachService["lt4:std"]
-
-        # get estimated departure time
-        thisDeparture["expected_departure_time"] = eachService["lt4:etd"]
-
-        # get carriages, if available
-        if 'lt4:length' in eachService:
-            thisDeparture["carriages"] = eachService["lt4:length"]
-        else:
-            thisDeparture["carriages"] = 0
-
-        # get operator, if available
-        if 'lt4:operator' in eachService:
-            thisDeparture["operator"] = eachService["lt4:operator"]
-
-        # get name of destination
-        if not isinstance(eachService['lt5:destination']['lt4:location'], list):    # the service only has one destination
-            thisDeparture["destination_name"] = removeBrackets(eachService['lt5:destination']['lt4:location']['lt4:locationName'])
-        else:  # the service splits and has multiple destinations
-            DestinationList = [i['lt4:locationName'] for i in eachService['lt5:destination']['lt4:location']]
-            thisDeparture["destination_name"] = " & ".join([removeBrackets(i) for i in DestinationList])
-
-        # get via and add to destination name
-        # if 'lt4:via' in eachService['lt5:destination']['lt4:location']:
-        #    thisDeparture["destination_name"] += " " + eachService['lt5:destination']['lt4:location']['lt4:via']
-
-            # get calling points
-        if 'lt7:subsequentCallingPoints' in eachService:  # there are some calling points
-            # check if it is a list of lists    (the train splits, so there are multiple lists of calling points)
-            # or a dict                         (the train does not split. There is one list of calling points)
-            if not isinstance(eachService['lt7:subsequentCallingPoints']['lt7:callingPointList'], dict):
-                # there are multiple lists of calling points
-                CallingPointList = eachService['lt7:subsequentCallingPoints']['lt7:callingPointList']
-                CallLists = []
-                CallListJoined = []
-                for sectionNum, eachSection in enumerate(CallingPointList):
-                    if isinstance(eachSection['lt7:callingPoint'], dict):
-                        # there is only one calling point in this list
-                        CallLists.append([prepareLocationName(eachSection['lt7:callingPoint'], show_individual_departure_time)])
-                        CallListJoined.append(CallLists[sectionNum])
-                    else:  # there are several calling points in this list
-                        CallLists.append([prepareLocationName(i, show_individual_departure_time) for i in eachSection['lt7:callingPoint']])
-
-                        CallListJoined.append(joinwithCommas(CallLists[sectionNum]))
-                        # CallListJoined.append(", ".join(CallLists[sectionNum]))
-                thisDeparture["calling_at_list"] = joinWithSpaces(
-                    " with a portion going to ".join(CallListJoined),
-                    "  --  ",
-                    prepareServiceMessage(thisDeparture["operator"]),
-                    prepareCarriagesMessage(thisDeparture["carriages"])
-                )
-
-            else:  # there is one list of calling points
-                if isinstance(eachService['lt7:subsequentCallingPoints']['lt7:callingPointList']['lt7:callingPoint'], dict):
-                    # there is only one calling point in the list
-                    thisDeparture["calling_at_list"] = joinWithSpaces(
-                        prepareLocationName(eachService['lt7:subsequentCallingPoints']['lt7:callingPointList']['lt7:callingPoint'], show_individual_departure_time),
-                        "only.",
-                        "  --  ",
-                        prepareServiceMessage(thisDeparture["operator"]),
-                        prepareCarriagesMessage(thisDeparture["carriages"])
-                    )
-                else:  # there are several calling points in the list
-                    CallList = [prepareLocationName(i, show_individual_departure_time) for i in eachService['lt7:subsequentCallingPoints']['lt7:callingPointList']['lt7:callingPoint']]
-                    thisDeparture["calling_at_list"] = joinWithSpaces(
-                        joinwithCommas(CallList) + ".",
-                        " --  ",
-                        prepareServiceMessage(thisDeparture["operator"]),
-                        prepareCarriagesMessage(thisDeparture["carriages"])
-                    )
-        else:  # there are no calling points, so just display the destination
-            thisDeparture["calling_at_list"] = joinWithSpaces(
-                thisDeparture["destination_name"],
-                "only.",
-                prepareServiceMessage(thisDeparture["operator"]),
-                prepareCarriagesMessage(thisDeparture["carriages"])
-            )
-
-        Departures[servicenum] = thisDeparture
+    if maxDepartures is not None:
+        Departures = Departures[:maxDepartures]
 
     return Departures, departureStationName
 
 
 
-def loadDeparturesForStation(journeyConfig, apiKey, rows):
-    if journeyConfig["departureStation"] == "":
-        raise ValueError("Please configure the departureStation environment variable")
-
-    if apiKey is None:
-        raise ValueError("Please configure the apiKey environment variable")
-
-    if rows is None:
-        raise ValueError("The number of rows to fetch must be specified")
-
-    destinationStation = journeyConfig["destinationStation"]
-    filterCrs = f"<ldb:filterCrs>{destinationStation}</ldb:filterCrs>" if destinationStation else ""
-
-    APIRequest = f"""
+def minutesUntilDeparture(departure, now):
+    departureMinutes = departure.departure_time
+    nowMinutes = now.hour * 60 + now.minute
+    # boards only look a couple of hours ahead, so anything more than
+    # twelve hours "away" is really earlier today or yesterday
+    minutes = (departureMinutes - nowMinutes) % (24 * 60)
+    return minutes if minutes <= 12 * 60 else minutes - 24 * 60
+
+def dropDeparted(Departures, now=None):
+    if Departures is None:
+        return None
+    now = now or datetime.now()
+    remaining = [i for i in Departures if minutesUntilDeparture(i, now) >= 0]
+    return remaining or None
+
+def departureFromFields(fields):
+    departure = Departure(*fields)
+    if departure.calling_points is not None:
+        departure.calling_points = [[CallingPoint(*i) for i in eachSection] for eachSection in departure.calling_points]
+    return departure
+
+def saveBoard(cachePath, Departures, departureStationName):
+    board = {
+        "fetchedAt": time.time(),
+        "stationName": departureStationName,
+        # departures as plain field lists, in Departure/CallingPoint field order
+        "departures": None if Departures is None else [astuple(i) for i in Departures]
+    }
+    # write to a temporary file and rename it over the old one, so a power cut
+    # mid-write never leaves a half-written cache behind
+    tempPath = cachePath + ".tmp"
+    with open(tempPath, 'w') as cacheFile:
+        json.dump(board, cacheFile, separators=(',', ':'))
+    os.replace(tempPath, cachePath)
+
+def loadBoard(cachePath, maxAge):
+    """Read the board saved by saveBoard, dropping departures that have already left.
+    Returns (Departures, departureStationName, fetchedAt), or None if there is no
+    cached board or it is more than maxAge seconds old."""
+    try:
+        with open(cachePath, 'r') as cacheFile:
+            board = json.load(cacheFile)
+        Departures = None if board["departures"] is None else [departureFromFields(i) for i in board["departures"]]
+        stationName = board["stationName"]
+        fetchedAt = float(board["fetchedAt"])
+    except (OSError, ValueError, KeyError, TypeError):
+        # missing, unreadable, or written by a version with different fields
+        return None
+
+    if maxAge is not None and time.time() - fetchedAt > maxAge:
+        return None
+
+    return dropDeparted(Departures), stationName, fetchedAt
+
+API_URL = "https://lite.realtime.nationalrail.co.uk/OpenLDBWS/ldb11.asmx"
+# seconds to wait for the TCP/TLS connection, and then for the board to arrive
+API_TIMEOUT = (5, 20)
+
+DEPARTURE_BOARD_REQUEST = string.Template("""
         <x:Envelope xmlns:x="http://schemas.xmlsoap.org/soap/envelope/" xmlns:ldb="http://thalesgroup.com/RTTI/2017-10-01/ldb/" xmlns:typ4="http://thalesgroup.com/RTTI/2013-11-28/Token/types">
         <x:Header>
-            <typ4:AccessToken><typ4:TokenValue>{apiKey}</typ4:TokenValue></typ4:AccessToken>
+            <typ4:AccessToken><typ4:TokenValue>$apiKey</typ4:TokenValue></typ4:AccessToken>
         </x:Header>
         <x:Body>
-            <ldb:GetDepBoardWithDetailsRequest>
-                <ldb:numRows>{rows}</ldb:numRows>
-                <ldb:crs>{journeyConfig["departureStation"]}</ldb:crs>
-                <ldb:timeOffset>{journeyConfig["timeOffset"]}</ldb:timeOffset>
-                {filterCrs}
+            <ldb:${operation}Request>
+                <ldb:numRows>$rows</ldb:numRows>
+                <ldb:crs>$crs</ldb:crs>
+                <ldb:timeOffset>$timeOffset</ldb:timeOffset>
+                $filterCrs
                 <ldb:filterType>to</ldb:filterType>
                 <ldb:timeWindow>120</ldb:timeWindow>
-            </ldb:GetDepBoardWithDetailsRequest>
+            </ldb:${operation}Request>
         </x:Body>
-    </x:Envelope>"""
+    </x:Envelope>""")
 
-    headers = {'Content-Type': 'text/xml'}
-    apiURL = "https://lite.realtime.nationalrail.co.uk/OpenLDBWS/ldb11.asmx"
+SERVICE_DETAILS_REQUEST = string.Template("""
+        <x:Envelope xmlns:x="http://schemas.xmlsoap.org/soap/envelope/" xmlns:ldb="http://thalesgroup.com/RTTI/2017-10-01/ldb/" xmlns:typ4="http://thalesgroup.com/RTTI/2013-11-28/Token/types">
+        <x:Header>
+            <typ4:AccessToken><typ4:TokenValue>$apiKey</typ4:TokenValue></typ4:AccessToken>
+        </x:Header>
+        <x:Body>
+            <ldb:GetServiceDetailsRequest>
+                <ldb:serviceID>$serviceID</ldb:serviceID>
+            </ldb:GetServiceDetailsRequest>
+        </x:Body>
+    </x:Envelope>""")
+
+# seconds a service's calling points are reused for before being fetched again
+SERVICE_DETAILS_TTL = 900
+# stations fetched at once; the session keeps this many connections open
+API_WORKERS = 4
+
+_session = None
+_sessionLock = threading.Lock()
+
+def getSession():
+    # one pooled keep-alive session for the whole process, so each refresh
+    # reuses the connection instead of doing a new TCP+TLS handshake.
+    # requests is imported where it is used rather than at the top, so
+    # startup doesn't wait on it before the first frame is drawn
+    import requests.adapters
+    global _session
+    with _sessionLock:
+        if _session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=API_WORKERS, max_retries=1)
+            session.mount("https://", adapter)
+            session.headers.update({
+                'Content-Type': 'text/xml',
+                'Accept-Encoding': 'gzip, deflate',
+                'Connection': 'keep-alive'
+            })
+            _session = session
+    return _session
+
+# every call made to LDBWS, so the refresh policy can keep within an hourly budget
+apiRequestCount = 0
+# what went wrong with the most recent request, or None if it worked
+lastRequestError = None
+_requestCountLock = threading.Lock()
+
+requestLatency = registry.histogram("trains_api_request_seconds", "Time taken by each LDBWS request", LATENCY_BUCKETS)
+parseTime = registry.histogram("trains_parse_seconds", "Time taken to parse each departure board", PARSE_BUCKETS)
+registry.gauge("trains_api_requests_total", "LDBWS requests made", lambda: apiRequestCount, "counter")
+
+def postRequest(APIRequest):
+    import requests
+    global apiRequestCount, lastRequestError
+    with _requestCountLock:
+        apiRequestCount += 1
+    try:
+        with requestLatency.time():
+            response = getSession().post(API_URL, data=APIRequest, timeout=API_TIMEOUT)
+        response.raise_for_status()
+    except requests.RequestException as err:
+        lastRequestError = type(err).__name__
+        raise
+    lastRequestError = None
+    return response
+
+@functools.lru_cache(maxsize=8)
+def prepareDepartureBoardRequest(apiKey, rows, departureStation, timeOffset, destinationStation, operation="GetDepBoardWithDetails"):
+    filterCrs = f"<ldb:filterCrs>{destinationStation}</ldb:filterCrs>" if destinationStation else ""
+    return DEPARTURE_BOARD_REQUEST.substitute(
+        operation=operation,
+        apiKey=apiKey,
+        rows=rows,
+        crs=departureStation,
+        timeOffset=timeOffset,
+        filterCrs=filterCrs
+    ).encode('utf-8')
+
+def prepareServiceDetailsRequest(apiKey, serviceID):
+    return SERVICE_DETAILS_REQUEST.substitute(apiKey=apiKey, serviceID=serviceID).encode('utf-8')
+
+def ProcessServiceDetails(APIOut):
+    # the calling points of a GetServiceDetails response, one list per portion of the train
+    if isinstance(APIOut, str):
+        APIOut = APIOut.encode('utf-8')
+    for element in ET.fromstring(APIOut).iter():
+        if localName(element.tag) == 'subsequentCallingPoints':
+            return [
+                [prepareCallingPoint(i) for i in childrenNamed(eachSection, 'callingPoint')]
+                for eachSection in childrenNamed(element, 'callingPointList')
+            ]
+    return []
+
+class ServiceDetailsCache:
+    """Calling points per serviceID. A service's route almost never changes
+    between polls, so they are only fetched again once ttl seconds old."""
+
+    def __init__(self, ttl=SERVICE_DETAILS_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, serviceID):
+        with self._lock:
+            entry = self._entries.get(serviceID)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def put(self, serviceID, CallingPoints):
+        now = time.monotonic()
+        with self._lock:
+            self._entries[serviceID] = (now, CallingPoints)
+            # services drop off the board once they've left, so forget expired ones
+            for expired in [k for k, v in self._entries.items() if now - v[0] > self.ttl]:
+                del self._entries[expired]
+
+serviceDetailsCache = ServiceDetailsCache()
+registry.gauge("trains_service_details_cache_hits_total", "Calling points found in the service details cache",
+               lambda: serviceDetailsCache.hits, "counter")
+registry.gauge("trains_service_details_cache_misses_total", "Calling points that had to be fetched",
+               lambda: serviceDetailsCache.misses, "counter")
+
+def loadServiceDetails(serviceID, apiKey):
+    CallingPoints = serviceDetailsCache.get(serviceID)
+    if CallingPoints is None:
+        response = postRequest(prepareServiceDetailsRequest(apiKey, serviceID))
+        CallingPoints = ProcessServiceDetails(response.content)
+        serviceDetailsCache.put(serviceID, CallingPoints)
+    return CallingPoints
+
+def departuresWithCallingPoints(Departures, perPlatform=False):
+    # only the first departure's calling points scroll across the screen, or the
+    # first on each platform when the board is shared with displays that filter by it
+    shown = [Departures[0]]
+    if perPlatform:
+        platforms = {Departures[0].platform}
+        for departure in Departures[1:]:
+            if departure.platform not in platforms:
+                platforms.add(departure.platform)
+                shown.append(departure)
+    return shown
+
+def loadDeparturesForStation(journeyConfig, apiKey, rows, displayRows=None, cachePath=None, cacheMaxAge=None):
+    """Fetch and parse one station's board. Returns (Departures, departureStationName,
+    fetchedAt), where fetchedAt is the time.time() the departures were fetched at; it is
+    older than the call when the API couldn't be reached and the cached board is served."""
+    import requests
+    if journeyConfig["departureStation"] == "":
+        raise ValueError("Please configure the departureStation environment variable")
 
-    APIOut = requests.post(apiURL, data=APIRequest, headers=headers).text
+    if apiKey is None:
+        raise ValueError("Please configure the apiKey environment variable")
 
-    Departures, departureStationName = ProcessDepartures(journeyConfig, APIOut)
+    if rows is None:
+        raise ValueError("The number of rows to fetch must be specified")
 
-    return Departures, departureStationName
+    # either poll the full board with every service's calling points, or poll
+    # the lighter board and fill in calling points from the service details cache
+    fetchServiceDetails = journeyConfig.get("fetchServiceDetails", False)
+    serviceDetailsCache.ttl = journeyConfig.get("serviceDetailsTTL", SERVICE_DETAILS_TTL)
+
+    APIRequest = prepareDepartureBoardRequest(
+        apiKey,
+        rows,
+        journeyConfig["departureStation"],
+        journeyConfig["timeOffset"],
+        journeyConfig["destinationStation"],
+        "GetDepartureBoard" if fetchServiceDetails else "GetDepBoardWithDetails"
+    )
+
+    try:
+        response = postRequest(APIRequest)
+    except requests.RequestException as err:
+        # serve the last good board while the API is down, as long as it isn't too old
+        cached = loadBoard(cachePath, cacheMaxAge) if cachePath else None
+        if cached is None:
+            raise
+        logging.warning("Failed to fetch departures, showing board from %s: %s",
+                        datetime.fromtimestamp(cached[2]).strftime("%H:%M:%S"), err)
+        return cached
+    fetchedAt = time.time()
+
+    with parseTime.time():
+        Departures, departureStationName = ProcessDepartures(journeyConfig, response.content, displayRows)
+
+    if fetchServiceDetails and Departures is not None:
+        # the light board has no calling points; those not fetched below stay unknown
+        for departure in Departures:
+            departure.calling_points = None
+        # every row is kept when other displays pick their own platform from the board
+        for departure in departuresWithCallingPoints(Departures, perPlatform=displayRows is None):
+            if departure.service_id is None:
+                continue
+            try:
+                departure.calling_points = loadServiceDetails(departure.service_id, apiKey)
+            except requests.RequestException as err:
+                # show the service without its calling points rather than not at all
+                logging.warning("Failed to fetch calling points for %s: %s", departure.service_id, err)
+
+    if cachePath:
+        try:
+            saveBoard(cachePath, Departures, departureStationName)
+        except OSError as err:
+            logging.warning("Failed to save departures to %s: %s", cachePath, err)
+
+    return Departures, departureStationName, fetchedAt
+
+def loadDeparturesForStations(journeyConfigs, apiKey, rows, displayRows=None, maxWorkers=API_WORKERS):
+    """Fetch and parse several boards at once, over the shared session's connection
+    pool, so a refresh takes about as long as the slowest station rather than all
+    of them one after another. Yields (journeyConfig, result, seconds) as each
+    board completes, where result is (Departures, departureStationName, fetchedAt),
+    or the exception that fetching or parsing that station raised."""
+    import concurrent.futures
+
+    def timedLoad(journeyConfig):
+        start = time.perf_counter()
+        try:
+            result = loadDeparturesForStation(journeyConfig, apiKey, rows, displayRows)
+        except Exception as err:
+            # not just network errors: one station answering with, say, an HTML
+            # maintenance page mustn't lose the boards the others returned
+            result = err
+        return result, time.perf_counter() - start
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(maxWorkers, len(journeyConfigs)) or 1) as pool:
+        futures = {pool.submit(timedLoad, journeyConfig): journeyConfig for journeyConfig in journeyConfigs}
+        for future in concurrent.futures.as_completed(futures):
+            result, seconds = future.result()
+            logging.debug("Fetched %s in %.3fs", futures[future]["departureStation"], seconds)
+            yield futures[future], result, seconds
+
+def mergeDepartures(boards):
+    # one board from several, e.g. the same origin filtered to several destinations;
+    # a service that appears on more than one of them is only shown once
+    Departures = {}
+    for eachBoard in boards:
+        for departure in eachBoard or []:
+            Departures.setdefault(departure.service_id or id(departure), departure)
+    return ArrivalOrder(Departures.values()) or None
@@ -0,0 +1,217 @@
+"""Off-hardware checks of the partial display updates.
+
+An SSD1322 is driven through CaptureSerial, which replays the windowed
+writes into a copy of the panel's RAM, and after every frame that RAM is
+compared with the frame the viewport displayed:
+
+    python3 -m unittest discover tests
+"""
+import os
+import random
+import sys
+import unittest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+from luma.core.framebuffer import diff_to_previous, full_frame
+from luma.core.virtual import hotspot, viewport
+from luma.oled.device import ssd1322
+from PIL import Image, ImageDraw
+
+from partialdisplay import CaptureSerial, DirtyBands, FastSSD1322, FrameDeduplicator
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class Block(hotspot):
+
+    def __init__(self, width, height):
+        """Hotspot that draws a bar at a given column, and only redraws when told to"""
+        super().__init__(width, height, self.draw)
+        self.x = 0
+        self.redraw = True
+
+    def should_redraw(self):
+        return self.redraw
+
+    def draw(self, draw, width, height):
+        draw.rectangle((self.x, 0, self.x + 5, height - 1), fill="white")
+
+
+class PanelTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.serial = CaptureSerial()
+        self.dirtyBands = DirtyBands()
+        self.device = ssd1322(self.serial, mode="1", rotate=2, framebuffer=self.dirtyBands)
+        self.shown = None
+
+        # remember every frame the device is given, including device.clear()
+        display = self.device.display
+
+        def recordingDisplay(image):
+            self.shown = image.copy()
+            display(image)
+
+        self.device.display = recordingDisplay
+
+    def board(self, device=None, rows=3):
+        virtual = viewport(device or self.device, width=256, height=64)
+        blocks = [Block(256, 12) for _ in range(rows)]
+        for i, block in enumerate(blocks):
+            block.x = 40 * i
+            virtual.add_hotspot(block, (0, 16 * i))
+        return virtual, blocks
+
+    def refresh(self, virtual):
+        self.dirtyBands.begin(virtual)
+        virtual.refresh()
+        self.assertPanelShows(self.shown)
+
+    def assertPanelShows(self, image):
+        expected = self.device.preprocess(image).convert('L').point(lambda p: 255 if p else 0)
+        actual = self.serial.frame().point(lambda p: 255 if p else 0)
+        self.assertEqual(expected.tobytes(), actual.tobytes())
+
+
+class DirtyBandsTest(PanelTestCase):
+
+    def test_hinted_rows(self):
+        virtual, blocks = self.board()
+        self.refresh(virtual)
+        for frame in range(30):
+            # only the middle row moves, and the last one now and then
+            blocks[1].x = frame * 7 % 250
+            blocks[2].x = frame // 5 * 11
+            for i, block in enumerate(blocks):
+                block.redraw = i == 1 or frame % 5 == 0
+            self.refresh(virtual)
+        self.assertGreater(self.dirtyBands.windows_sent, 1)
+
+    def test_viewport_switch(self):
+        board, boardBlocks = self.board()
+        other, otherBlocks = self.board(rows=2)
+        for block in otherBlocks:
+            block.x = 200
+        for frame, virtual in enumerate([board, board, other, board, other, other, board]):
+            # on its first frame back, a viewport only repaints the hotspots due to redraw
+            for block in boardBlocks + otherBlocks:
+                block.redraw = frame == 0
+            boardBlocks[0].x = frame * 9
+            boardBlocks[0].redraw = True
+            self.refresh(virtual)
+
+    def test_clear_between_frames(self):
+        virtual, blocks = self.board()
+        self.refresh(virtual)
+        for block in blocks[1:]:
+            block.redraw = False
+
+        self.device.clear()
+        self.assertPanelShows(Image.new("1", (256, 64)))
+
+        # only the first row repaints, but the rest have to come back as well
+        blocks[0].x = 100
+        self.refresh(virtual)
+
+    def test_skipped_frame_then_change(self):
+        deduplicated = FrameDeduplicator(self.device)
+        virtual, blocks = self.board(deduplicated)
+        self.refresh(virtual)
+
+        for block in blocks:
+            block.redraw = False
+        skipped = deduplicated.frames_skipped
+        self.refresh(virtual)
+        self.assertEqual(deduplicated.frames_skipped, skipped + 1)
+
+        blocks[2].x = 120
+        blocks[2].redraw = True
+        self.refresh(virtual)
+
+        blocks[2].redraw = False
+        deduplicated.clear()
+        self.assertPanelShows(Image.new("1", (256, 64)))
+        self.refresh(virtual)
+
+    def test_skipped_frame_then_clear(self):
+        deduplicated = FrameDeduplicator(self.device)
+        virtual, blocks = self.board(deduplicated)
+        self.refresh(virtual)
+
+        # begin() is called for a frame that is then skipped, so its hint must not outlive it
+        blocks[0].redraw = False
+        blocks[2].redraw = False
+        self.refresh(virtual)
+        deduplicated.clear()
+        self.assertPanelShows(Image.new("1", (256, 64)))
+
+        self.refresh(virtual)
+        self.refresh(virtual)
+        other = Image.new("1", (256, 64))
+        ImageDraw.Draw(other).text((0, 0), "Welcome to", fill="white")
+        deduplicated.display(other)
+        self.assertPanelShows(other)
+
+
+class RecordingSerial(CaptureSerial):
+
+    def __init__(self) -> None:
+        """CaptureSerial that also keeps every command and data call, in order"""
+        super().__init__()
+        self.calls = []
+
+    def command(self, *cmd):
+        self.calls.append(('command', list(cmd)))
+        super().command(*cmd)
+
+    def data(self, data):
+        self.calls.append(('data', list(data)))
+        super().data(data)
+
+
+class FastSSD1322Test(unittest.TestCase):
+
+    def frames(self, mode, size):
+        # bars that move and change shade, so every frame redraws some regions and not others
+        rand = random.Random(1322)
+        image = Image.new(mode, size)
+        frames = []
+        for _ in range(12):
+            draw = ImageDraw.Draw(image)
+            for _ in range(3):
+                x, y = rand.randrange(size[0]), rand.randrange(size[1])
+                colour = rand.randrange(2) if mode == "1" else tuple(rand.randrange(256) for _ in range(3))
+                draw.rectangle((x, y, x + rand.randrange(1, 40), y + rand.randrange(1, 12)), fill=colour)
+            frames.append(image.copy())
+        return frames
+
+    def assertSameCalls(self, expected, actual):
+        # assertEqual's diff takes forever over frames of bytes, so just point at the first call that differs
+        for i, (want, got) in enumerate(zip(expected, actual)):
+            if want != got:
+                self.fail(f"call {i} differs: {want[0]} of {len(want[1])} bytes")
+        self.assertEqual(len(expected), len(actual), "different number of calls")
+
+    def test_same_traffic_as_ssd1322(self):
+        for mode in ("1", "RGB"):
+            for rotate in range(4):
+                for framebuffer in (diff_to_previous, full_frame, DirtyBands):
+                    with self.subTest(mode=mode, rotate=rotate, framebuffer=framebuffer.__name__):
+                        serials = RecordingSerial(), RecordingSerial()
+                        stock = ssd1322(serials[0], mode=mode, rotate=rotate, framebuffer=framebuffer())
+                        fast = FastSSD1322(serials[1], mode=mode, rotate=rotate, framebuffer=framebuffer())
+                        for frame in self.frames(mode, stock.size):
+                            stock.display(frame)
+                            fast.display(frame)
+                        self.assertSameCalls(serials[0].calls, serials[1].calls)
+                        self.assertTrue(serials[0].ram == serials[1].ram, "panel RAM differs")
+                        self.assertEqual(fast.vectorised, numpy is not None)
+
+
+if __name__ == '__main__':
+    unittest.main()